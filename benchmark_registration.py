@@ -0,0 +1,91 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import ants
+import numpy as np
+import yaml
+
+from src.pipeline import MRIPreprocessingPipeline
+
+
+def masked_correlation(fixed, warped, mask=None):
+    """Pearson correlation of two images on the same grid, inside `mask` if given."""
+    a = fixed.numpy().ravel()
+    b = warped.numpy().ravel()
+    if mask is not None:
+        keep = mask.numpy().ravel() > 0
+        a, b = a[keep], b[keep]
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def benchmark(config_path, images, presets):
+    pipeline = MRIPreprocessingPipeline(config_path)
+    reg_cfg = pipeline.cfg['preprocessing']['registration']
+    template = pipeline.mni_template
+    # Score inside the template brain mask (full grid) when one is configured
+    mask = None
+    if pipeline.template_mask is not None:
+        mask = ants.resample_image_to_target(pipeline.template_mask, template, interp_type='nearestNeighbor')
+
+    rows = []
+    for preset in presets:
+        times, mi, corr = [], [], []
+        for path in images:
+            moving = ants.image_read(path)
+            start = time.perf_counter()
+            result = ants.registration(
+                fixed=pipeline.registration_template,
+                moving=moving,
+                type_of_transform=reg_cfg['type'],
+                mask=pipeline.template_mask,
+                **pipeline.registration_kwargs(preset)
+            )
+            times.append(time.perf_counter() - start)
+            warped = ants.apply_transforms(
+                fixed=template,
+                moving=moving,
+                transformlist=result['fwdtransforms'],
+                interpolator=reg_cfg['interpolator'],
+                defaultvalue=moving.min()
+            )
+            # image_similarity returns the negated metric (lower is better for ANTs)
+            mi.append(-float(ants.image_similarity(template, warped, metric_type='MattesMutualInformation',
+                                                   fixed_mask=mask)))
+            corr.append(masked_correlation(template, warped, mask))
+            print(f"  {preset:>9} {os.path.basename(path)}: {times[-1]:.1f}s  MI={mi[-1]:.4f}  r={corr[-1]:.4f}")
+        rows.append((preset, np.mean(times), np.max(times), np.mean(mi), np.mean(corr)))
+
+    print(f"\n{'preset':>10} {'mean s':>8} {'max s':>8} {'MI':>8} {'corr':>8}")
+    for preset, mean_t, max_t, mean_mi, mean_corr in rows:
+        print(f"{preset:>10} {mean_t:8.1f} {max_t:8.1f} {mean_mi:8.4f} {mean_corr:8.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and score registration presets on HR images")
+    parser.add_argument("--config", type=str, default="./configs/config.yaml", help="Path to config")
+    parser.add_argument("--images", nargs="*", default=None,
+                        help="Moving images (default: normalized HR intermediates, *_04_hr_norm.nii.gz)")
+    parser.add_argument("--presets", nargs="*", default=None,
+                        help="Presets to compare (default: every configured preset plus 'default')")
+    parser.add_argument("--limit", type=int, default=5, help="Maximum number of images")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        cfg = yaml.safe_load(f)
+
+    images = args.images
+    if not images:
+        intermediate_dir = cfg['paths'].get('intermediate_dir', os.path.join(cfg['paths']['output_dir'], "intermediate"))
+        images = sorted(glob.glob(os.path.join(intermediate_dir, '*', '*_04_hr_norm.nii.gz')))
+    images = images[:args.limit]
+    if not images:
+        print("No images to register; run the pipeline with save_intermediates or pass --images.")
+        sys.exit(1)
+
+    presets = args.presets
+    if not presets:
+        presets = ['default'] + list(cfg['preprocessing']['registration'].get('presets', {}))
+
+    benchmark(args.config, images, presets)
@@ -102,20 +102,32 @@ def example_4_processing_pipeline_stages():
     intermediate_dir = Path(f"data/processed/intermediate/{subject}")
     
     stages = {
-        "Brain Extracted": f"{subject}_00_brain_extracted.nii.gz",
-        "Reoriented": f"{subject}_01_raw_reoriented.nii.gz",
-        "N4 Corrected": f"{subject}_03_hr_n4.nii.gz",
-        "Normalized": f"{subject}_04_hr_norm.nii.gz",
+        "Brain Extracted": "00_brain_extracted",
+        "Reoriented": "01_raw_reoriented",
+        "N4 Corrected": "03_hr_n4",
+        "Normalized": "04_hr_norm",
     }
     
     file_list = []
     labels = []
     
-    for label, filename in stages.items():
-        filepath = intermediate_dir / filename
-        if filepath.exists():
-            file_list.append(filepath)
-            labels.append(label)
+    zarr_path = Path(f"data/processed/intermediate/{subject}.zarr")
+    if zarr_path.exists():
+        # intermediate_backend: "zarr" - read the stages from the subject's chunked
+        # store (pass roi=... to ZarrIntermediateStore.read to decode only a slab)
+        from src.intermediate_store import ZarrIntermediateStore
+        store = ZarrIntermediateStore("data/processed/intermediate")
+        available = store.steps(subject)
+        for label, step in stages.items():
+            if step in available:
+                file_list.append(store.read(subject, step))
+                labels.append(label)
+    else:
+        for label, step in stages.items():
+            filepath = intermediate_dir / f"{subject}_{step}.nii.gz"
+            if filepath.exists():
+                file_list.append(filepath)
+                labels.append(label)
     
     if len(file_list) > 1:
         stats = compare_mri_histograms(
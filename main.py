@@ -1,14 +1,63 @@
 # main.py
-from src.pipeline import MRIPreprocessingPipeline
+from src.pipeline import MRIPreprocessingPipeline, load_normalization_input
+from src.normalize import fit_nyul_landmarks
 import argparse
+import functools
+import os
+import yaml
+
+
+def fit_nyul(config_path, input_dir=None, workers=None):
+    """
+    Fits the Nyúl landmark index configured in normalization.nyul and saves it.
+
+    Landmarks are fitted on the images normalization is applied to (after brain
+    extraction, cropping and N4, as configured), not on the raw scans.
+    """
+    with open(config_path, 'r') as f:
+        cfg = yaml.safe_load(f)
+    nyul_cfg = cfg['preprocessing']['normalization'].get('nyul', {})
+    input_dir = input_dir or cfg['paths']['input_dir']
+    paths = sorted(
+        os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(('.nii.gz', '.nii'))
+    )
+    landmarks = fit_nyul_landmarks(
+        paths,
+        percentiles=nyul_cfg.get('percentiles', (1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 99)),
+        output_range=nyul_cfg.get('output_range', (1.0, 100.0)),
+        workers=workers or cfg.get('pipeline_options', {}).get('workers', 1),
+        load=functools.partial(load_normalization_input, config_path),
+    )
+    for path, error in landmarks.failed:
+        print(f"Skipped {path}: {error}")
+    landmarks_path = nyul_cfg.get('landmarks_path', os.path.join(cfg['paths']['output_dir'], 'nyul_landmarks.json'))
+    landmarks.save(landmarks_path)
+    print(f"Nyúl landmarks fitted on {landmarks.n_images} images -> {landmarks_path}")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="MRI Super-Resolution Preprocessing")
     parser.add_argument("--config", type=str, default="./configs/config.yaml", help="Path to config")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of subjects processed in parallel (overrides pipeline_options.workers)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Reprocess every subject, ignoring the batch journal")
+    parser.add_argument("--fit-nyul", nargs="?", const="", default=None, metavar="DIR",
+                        help="Fit the Nyúl landmark index over DIR (default: input_dir) and exit")
+    parser.add_argument("--reapply", action="store_true",
+                        help="Regenerate HR/LR outputs from stored transforms (apply_transforms only)")
     args = parser.parse_args()
 
-    # Instantiate and Run
-    pipeline = MRIPreprocessingPipeline(args.config)
-    pipeline.run_batch()
-    
-    print("Pipeline complete. Data ready for WGAN training.")
\ No newline at end of file
+    if args.fit_nyul is not None:
+        fit_nyul(args.config, input_dir=args.fit_nyul or None, workers=args.workers)
+    elif args.reapply:
+        pipeline = MRIPreprocessingPipeline(args.config)
+        results = pipeline.reapply()
+        failed = [r for r in results if not r.success]
+        print(f"Reapplied transforms for {len(results) - len(failed)} subjects ({len(failed)} failed).")
+    else:
+        # Instantiate and Run
+        pipeline = MRIPreprocessingPipeline(args.config)
+        pipeline.run_batch(workers=args.workers, resume=False if args.no_resume else None)
+
+        print("Pipeline complete. Data ready for WGAN training.")
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import time
+import argparse
+import yaml
+
+from src.metrics import load_metrics, list_runs, summarize_metrics
+
+
+def report(metrics_dir, run_id='latest', as_json=False):
+    records = load_metrics(metrics_dir, run_id=run_id)
+    if not records:
+        print(f"No metrics found in {metrics_dir}" + (f" for run {run_id}" if run_id else ""))
+        sys.exit(1)
+    summary = summarize_metrics(records)
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print("Run: " + ", ".join(str(run) for run in summary['runs']))
+    print(f"{'stage':<18} {'count':>6} {'fail':>5} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} "
+          f"{'cpu s':>8} {'Mvox/s':>8} {'peak RSS GB':>12}")
+    for stage, s in summary['stages'].items():
+        rss = f"{s['peak_rss_max_bytes'] / 1e9:.2f}" if s['peak_rss_max_bytes'] else '-'
+        mvox = f"{s['mvoxels_per_s']:.2f}" if s['mvoxels_per_s'] else '-'
+        print(f"{stage:<18} {s['count']:>6} {s['failures']:>5} {s['wall_p50']:>8.2f} {s['wall_p90']:>8.2f} "
+              f"{s['wall_p99']:>8.2f} {s['cpu_mean']:>8.2f} {mvox:>8} {rss:>12}")
+
+    print(f"\nSubjects: {summary['subjects']} ({summary['failed_subjects']} failed)")
+    if summary['subjects_per_hour'] is not None:
+        print(f"Elapsed: {summary['elapsed_h']:.2f} h  Throughput: {summary['subjects_per_hour']:.1f} subjects/hour")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize per-stage pipeline metrics")
+    parser.add_argument("--config", type=str, default="./configs/config.yaml", help="Path to config")
+    parser.add_argument("--metrics-dir", type=str, default=None,
+                        help="Metrics directory (default: pipeline_options.metrics.dir or <output_dir>/metrics)")
+    parser.add_argument("--run", type=str, default="latest",
+                        help="Run id to summarize (default: the most recent run; see --list-runs)")
+    parser.add_argument("--all-runs", action="store_true", help="Summarize every recorded run together")
+    parser.add_argument("--list-runs", action="store_true", help="List the recorded runs and exit")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    metrics_dir = args.metrics_dir
+    if metrics_dir is None:
+        with open(args.config, 'r') as f:
+            cfg = yaml.safe_load(f)
+        metrics_dir = (cfg.get('pipeline_options', {}).get('metrics', {}).get('dir')
+                       or os.path.join(cfg['paths']['output_dir'], "metrics"))
+    if args.list_runs:
+        for run in list_runs(load_metrics(metrics_dir)):
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['start']))
+            print(f"{str(run['run_id']):<24} {started}  {run['subjects']:>5} subjects")
+        sys.exit(0)
+    report(metrics_dir, run_id=None if args.all_runs else args.run, as_json=args.json)
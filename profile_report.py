@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import argparse
+import yaml
+
+from src.profiling import load_profiles, top_functions
+
+
+def report(profile_dir, top=20, sort='tottime', stages=None, by_stage=False, as_json=False):
+    profiles = load_profiles(profile_dir, stages=stages)
+    if not profiles:
+        print(f"No cProfile files found in {profile_dir}")
+        sys.exit(1)
+
+    if by_stage:
+        groups = {stage: stats for stage, (stats, _) in profiles.items()}
+    else:
+        # One report over every selected stage of the batch
+        combined = None
+        for stats, _ in profiles.values():
+            if combined is None:
+                combined = stats
+            else:
+                combined.add(stats)
+        groups = {'all': combined}
+    counts = {stage: count for stage, (_, count) in profiles.items()}
+
+    result = {stage: top_functions(stats, n=top, sort=sort) for stage, stats in groups.items()}
+    if as_json:
+        print(json.dumps({'profiles': counts, 'top': result}, indent=2))
+        return
+
+    print("Profiles: " + ", ".join(f"{stage} ({count})" for stage, count in sorted(counts.items())))
+    for stage, rows in result.items():
+        total = groups[stage].total_tt
+        print(f"\n== {stage}: top {len(rows)} by {sort} (total {total:.2f} s) ==")
+        print(f"{'tottime s':>10} {'%':>6} {'cumtime s':>10} {'ncalls':>10}  function")
+        for r in rows:
+            share = 100.0 * r['tottime'] / total if total > 0 else 0.0
+            print(f"{r['tottime']:>10.3f} {share:>6.1f} {r['cumtime']:>10.3f} {r['ncalls']:>10}  {r['function']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate per-stage cProfile files into a hot-function report")
+    parser.add_argument("--config", type=str, default="./configs/config.yaml", help="Path to config")
+    parser.add_argument("--profile-dir", type=str, default=None,
+                        help="Profile directory (default: pipeline_options.profiling.dir or <output_dir>/profiles)")
+    parser.add_argument("--top", type=int, default=20, help="Number of functions to show")
+    parser.add_argument("--sort", choices=["tottime", "cumtime"], default="tottime",
+                        help="tottime: time in the function itself; cumtime: including callees")
+    parser.add_argument("--stage", action="append", default=None,
+                        help="Only include this stage (repeatable; e.g. --stage register --stage lr)")
+    parser.add_argument("--by-stage", action="store_true", help="One report per stage instead of a combined one")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    profile_dir = args.profile_dir
+    if profile_dir is None:
+        with open(args.config, 'r') as f:
+            cfg = yaml.safe_load(f)
+        profile_dir = (cfg.get('pipeline_options', {}).get('profiling', {}).get('dir')
+                       or os.path.join(cfg['paths']['output_dir'], "profiles"))
+    report(profile_dir, top=args.top, sort=args.sort, stages=args.stage, by_stage=args.by_stage, as_json=args.json)
@@ -1,4 +1,5 @@
-from .pipeline import MRIPreprocessingPipeline, PipelineResult, run_single
-from .brain_extraction import BrainExtractor
+from .pipeline import MRIPreprocessingPipeline, PipelineResult, BatchSummary, run_single
+from .pool import PipelinePool
+from .brain_extraction import BrainExtractor, BrainMaskCache
 from .normalize import IntensityNormalizer
 from .degradation import DegradationSimulator
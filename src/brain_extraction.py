@@ -1,12 +1,16 @@
 import os
 import time
+import shutil
+import hashlib
 import logging
 import tempfile
+import numpy as np
 import torch
 import ants
 import requests
 from HD_BET.hd_bet_prediction import get_hdbet_predictor, hdbet_predict
 from HD_BET.checkpoint_download import maybe_download_parameters
+from .utils import numpy_to_ants
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +40,90 @@ def _download_hd_bet_with_retry(max_retries: int = 5, base_delay: float = 10.0)
                 raise
 
 
+class BrainMaskCache:
+    """
+    Persistent LRU cache of HD-BET results on disk.
+
+    Entries are keyed by a hash of the input voxel data, its spatial header and
+    the predictor settings, and hold the brain-extracted image plus the brain
+    mask. Reruns, config experiments and run_single calls on the same scan
+    therefore skip inference. The least recently used entries are evicted once
+    the cache grows beyond `max_size_gb`.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=20.0):
+        """
+        Args:
+            cache_dir (str): Directory holding one sub-directory per cached scan.
+            max_size_gb (float): Size limit of the cache directory in gigabytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(float(max_size_gb) * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(ants_image, **settings):
+        """Hash of the voxel data, spatial header and predictor settings."""
+        h = hashlib.blake2b(digest_size=20)
+        data = np.ascontiguousarray(ants_image.numpy())
+        h.update(str((data.shape, data.dtype.str)).encode())
+        h.update(data.tobytes())
+        h.update(repr((tuple(ants_image.spacing), tuple(ants_image.origin),
+                       np.asarray(ants_image.direction).round(6).tolist())).encode())
+        h.update(repr(sorted(settings.items())).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple or None: (brain_image, mask_image) on a hit, None on a miss.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        brain_path = os.path.join(entry, 'brain.nii.gz')
+        mask_path = os.path.join(entry, 'mask.nii.gz')
+        if not (os.path.exists(brain_path) and os.path.exists(mask_path)):
+            return None
+        # Directory mtime records the last access for LRU eviction
+        os.utime(entry, None)
+        return ants.image_read(brain_path), ants.image_read(mask_path)
+
+    def put(self, key, brain_image, mask_image):
+        """Stores an HD-BET result and evicts old entries beyond the size limit."""
+        entry = os.path.join(self.cache_dir, key)
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{key}-', dir=self.cache_dir)
+        try:
+            ants.image_write(brain_image, os.path.join(tmp_dir, 'brain.nii.gz'))
+            ants.image_write(mask_image, os.path.join(tmp_dir, 'mask.nii.gz'))
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp_dir, entry)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size_gb."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue  # Removed concurrently by another worker
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logger.info("Evicted HD-BET cache entry %s", os.path.basename(entry))
+
+
 class BrainExtractor:
     """
     Handles brain extraction using HD-BET (High-Definition Brain Extraction Tool).
@@ -44,7 +132,8 @@ class BrainExtractor:
     in the preprocessing pipeline.
     """
     
-    def __init__(self, device='cpu', disable_tta=True, keep_mask=True, verbose=False):
+    def __init__(self, device='cpu', disable_tta=True, keep_mask=True, verbose=False, cache=None,
+                 in_memory=False):
         """
         Initialize the brain extractor.
         
@@ -53,11 +142,16 @@ class BrainExtractor:
             disable_tta (bool): If True, disables test-time augmentation (faster, recommended for CPU).
             keep_mask (bool): If True, keeps the binary brain mask file.
             verbose (bool): If True, prints detailed progress information.
+            cache (BrainMaskCache, optional): Persistent cache of extraction results.
+            in_memory (bool): If True, feed the volume to the predictor directly instead of
+                round-tripping through temporary gzipped NIfTI files.
         """
         self.device = device
         self.disable_tta = disable_tta
         self.keep_mask = keep_mask
         self.verbose = verbose
+        self.cache = cache
+        self.in_memory = in_memory
         
         # Download model parameters if not already present (with retry)
         _download_hd_bet_with_retry()
@@ -69,18 +163,86 @@ class BrainExtractor:
             device=torch.device(self.device),
             verbose=self.verbose
         )
+        if self.in_memory and not self._in_memory_supported():
+            logger.warning("HD-BET model does not read images with SimpleITK; using the file-based path.")
+            self.in_memory = False
+
+    def _in_memory_supported(self):
+        """Whether extract_brain_array reproduces the model's own image reader (nnU-Net SimpleITKIO)."""
+        plans_manager = getattr(self.predictor, 'plans_manager', None)
+        reader = getattr(plans_manager, 'image_reader_writer_class', None)
+        return reader is None or reader.__name__ == 'SimpleITKIO'
+
+    def extract_brain_array(self, data, spacing):
+        """
+        Array-in/array-out HD-BET inference with no disk I/O.
+
+        The volume is handed to the predictor the way nnU-Net's SimpleITK reader
+        would load it, and the mask is applied directly; hdbet_predict's own
+        file-based post-processing is not run. Check the masks against the file
+        path with verify_hdbet_in_memory.py before enabling `in_memory`.
+
+        Args:
+            data (np.ndarray): 3D volume in ANTs/ITK index order (x, y, z).
+            spacing (tuple): Voxel spacing (mm) of the `data` axes.
+        
+        Returns:
+            tuple: (brain, mask) numpy arrays with the shape of `data`.
+        """
+        # nnU-Net's SimpleITK reader yields (c, z, y, x) with reversed spacing;
+        # transposing the ITK-ordered array reproduces exactly what it would read.
+        volume = np.ascontiguousarray(np.transpose(data, (2, 1, 0))[None], dtype=np.float32)
+        properties = {'spacing': [float(s) for s in spacing[::-1]]}
+        segmentation = self.predictor.predict_single_npy_array(volume, properties, None, None, False)
+        
+        mask = np.transpose(np.asarray(segmentation), (2, 1, 0)) > 0
+        brain = np.where(mask, data, 0).astype(data.dtype)
+        return brain, mask.astype(np.float32)
     
-    def extract_brain(self, ants_image, temp_dir=None):
+    def extract_brain_in_memory(self, ants_image):
+        """
+        Extract brain from an ANTsPy image without temporary files.
+        
+        Returns:
+            tuple: (brain_image, mask_image) ANTsPy images sharing the input header.
+        """
+        brain, mask = self.extract_brain_array(ants_image.numpy(), ants_image.spacing)
+        return numpy_to_ants(brain, ants_image), numpy_to_ants(mask, ants_image)
+    
+    def extract_brain(self, ants_image, temp_dir=None, return_mask=False):
         """
         Extract brain from an ANTsPy image.
         
         Args:
             ants_image: ANTsPy image object to extract brain from.
             temp_dir (str, optional): Directory for temporary files. If None, uses system temp.
+            return_mask (bool): If True, also return the HD-BET brain mask.
         
         Returns:
-            ANTsPy image object containing the brain-extracted image.
+            ANTsPy image object containing the brain-extracted image, or a
+            (brain_image, mask_image) tuple if return_mask is True.
         """
+        cache_key = None
+        if self.cache is not None:
+            # In-memory masks are cached separately until their parity is established
+            settings = {'in_memory': True} if self.in_memory else {}
+            cache_key = BrainMaskCache.make_key(
+                ants_image, use_tta=not self.disable_tta, device=str(self.device), **settings
+            )
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("HD-BET cache hit (%s), skipping inference.", cache_key)
+                return cached if return_mask else cached[0]
+
+        if self.in_memory:
+            brain_extracted, mask = self.extract_brain_in_memory(ants_image)
+            if self.cache is not None:
+                self.cache.put(cache_key, brain_extracted, mask)
+            return (brain_extracted, mask) if return_mask else brain_extracted
+
+        # The mask is needed whenever the caller or the cache wants it
+        need_mask = return_mask or self.cache is not None
+
         # Create temporary directory for processing
         if temp_dir is None:
             temp_dir = tempfile.mkdtemp()
@@ -88,6 +250,8 @@ class BrainExtractor:
         # Define temporary file paths
         input_path = os.path.join(temp_dir, "temp_input.nii.gz")
         output_path = os.path.join(temp_dir, "temp_output.nii.gz")
+        # HD-BET writes the mask next to the output as <name>_bet.nii.gz
+        mask_path = output_path.replace('.nii.gz', '_bet.nii.gz')
         
         try:
             # Save ANTsPy image to temporary NIfTI file
@@ -98,14 +262,19 @@ class BrainExtractor:
                 input_file_or_folder=input_path,
                 output_file_or_folder=output_path,
                 predictor=self.predictor,
-                keep_brain_mask=self.keep_mask,
+                keep_brain_mask=self.keep_mask or need_mask,
                 compute_brain_extracted_image=True
             )
             
             # Load the brain-extracted image back as ANTsPy image
             brain_extracted = ants.image_read(output_path)
-            
-            return brain_extracted
+            if not need_mask:
+                return brain_extracted
+
+            mask = ants.image_read(mask_path)
+            if self.cache is not None:
+                self.cache.put(cache_key, brain_extracted, mask)
+            return (brain_extracted, mask) if return_mask else brain_extracted
             
         finally:
             # Clean up temporary files
@@ -114,7 +283,6 @@ class BrainExtractor:
             if os.path.exists(output_path):
                 os.remove(output_path)
             # Also clean up mask file if it was created
-            mask_path = output_path.replace('.nii.gz', '_mask.nii.gz')
             if not self.keep_mask and os.path.exists(mask_path):
                 os.remove(mask_path)
             
@@ -124,3 +292,30 @@ class BrainExtractor:
                     os.rmdir(temp_dir)
                 except OSError:
                     pass  # Directory not empty, that's okay
+    
+    def iter_extract_brain(self, items):
+        """
+        Extracts several subjects one after another with this extractor's
+        long-lived predictor (one extract_brain call each, no batched
+        inference), yielding each result as soon as it is ready. Run from a
+        background thread, this lets downstream stages of one subject overlap
+        inference of the next.
+        
+        Args:
+            items: Iterable of (key, source) pairs, where source is a NIfTI path
+                or an ANTsPy image. Paths are read lazily, one at a time.
+        
+        Yields:
+            tuple: (key, brain_image, mask_image, error). On failure the images
+            are None and error holds the exception; the stream continues.
+        """
+        for key, source in items:
+            try:
+                image = ants.image_read(source) if isinstance(source, str) else source
+                brain, mask = self.extract_brain(image, return_mask=True)
+            except Exception as exc:
+                logger.error("Brain extraction failed for %s: %s", key, exc)
+                yield key, None, None, exc
+                continue
+            yield key, brain, mask, None
+
@@ -1,8 +1,95 @@
 import numpy as np
 import ants
-from scipy.fft import fftn, ifftn, fftshift, ifftshift
+from scipy.fft import rfftn, irfftn
+from scipy.signal import fftconvolve
+from scipy.special import erf
 import warnings
 
+SLICE_PROFILES = ('boxcar', 'gaussian', 'sinc')
+
+# FWHM of sinc(x) in units of its first zero crossing
+_SINC_FWHM = 1.2067
+
+
+def _mm_label(value):
+    """Formats a millimetre value for file suffixes: 3.0 -> '3', 2.5 -> '2p5'."""
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return f"{value:g}".replace('.', 'p')
+
+
+def slice_profile_kernel(profile, width):
+    """
+    Discrete slice profile sampled on the HR grid, normalized to unit sum.
+    
+    Args:
+        profile (str): 'boxcar' (ideal slab), 'gaussian' or 'sinc' (Hann-windowed,
+            three lobes per side). Gaussian and sinc are scaled so their FWHM
+            equals the nominal slice thickness.
+        width (float): Slice thickness in HR voxels (may be fractional).
+    
+    Returns:
+        np.ndarray: Odd-length symmetric kernel centred on its middle tap.
+    """
+    if profile == 'boxcar':
+        # Exact overlap of each voxel [m-0.5, m+0.5] with the slab [-w/2, w/2]
+        half = int(np.ceil(width / 2.0 + 0.5))
+        m = np.arange(-half, half + 1, dtype=np.float64)
+        kernel = np.clip(np.minimum(m + 0.5, width / 2.0) - np.maximum(m - 0.5, -width / 2.0), 0, None)
+    elif profile == 'gaussian':
+        sigma = width / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+        half = max(1, int(np.ceil(3.0 * sigma)))
+        m = np.arange(-half, half + 1, dtype=np.float64)
+        # Integrate the Gaussian over each voxel rather than point-sampling it
+        kernel = 0.5 * (erf((m + 0.5) / (np.sqrt(2.0) * sigma)) - erf((m - 0.5) / (np.sqrt(2.0) * sigma)))
+    elif profile == 'sinc':
+        zero_crossing = width / _SINC_FWHM
+        support = 3.0 * zero_crossing
+        half = max(1, int(np.ceil(support)))
+        m = np.arange(-half, half + 1, dtype=np.float64)
+        window = np.where(np.abs(m) <= support, 0.5 * (1.0 + np.cos(np.pi * m / support)), 0.0)
+        kernel = np.sinc(m / zero_crossing) * window
+    else:
+        raise ValueError(f"Unknown slice profile: {profile}. Options: {SLICE_PROFILES}")
+    return kernel / kernel.sum()
+
+
+def lr_variant_specs(sim_cfg):
+    """
+    Lists every LR variant configured in the `simulation` config section.
+    Thick-slice and gap variants use `simulation.slice_profile` (default boxcar).
+
+    Args:
+        sim_cfg (dict): The `simulation` section of the pipeline config.
+
+    Returns:
+        list: (suffix, kind, params) tuples in config order, where `kind` is the
+        DegradationSimulator.simulate() kind and `params` its keyword arguments.
+    """
+    specs = []
+    profile = sim_cfg.get('slice_profile', 'boxcar')
+
+    # 1. Thick Slices
+    for thickness in sim_cfg.get('thick_slices') or []:
+        specs.append((f"thick_{_mm_label(thickness)}mm", 'thick_slices',
+                      {'thickness_mm': float(thickness), 'profile': profile}))
+
+    # 2. Inter-slice Gaps
+    for gap_cfg in sim_cfg.get('inter_slice_gap') or []:
+        th = float(gap_cfg['thickness'])
+        gp = float(gap_cfg['gap'])
+        specs.append((f"gap_th{_mm_label(th)}_gap{_mm_label(gp)}mm", 'inter_slice_gap',
+                      {'thickness_mm': th, 'gap_mm': gp, 'profile': profile}))
+
+    # 3. In-plane Resolution
+    for factor in sim_cfg.get('in_plane_resolution') or []:
+        specs.append((f"inplane_ds{factor}", 'in_plane_resolution',
+                      {'downsample_factor': int(factor)}))
+
+    return specs
+
+
 class DegradationSimulator:
     """
     A physics-based MRI degradation simulator for generating low-resolution
@@ -14,6 +101,7 @@ class DegradationSimulator:
        summing spin magnetization over the slice width.
     2. In-plane Resolution: Simulated via K-space truncation (simulating finite 
        matrix size) to induce realistic Gibbs ringing, rather than smooth Gaussian blur.
+       Only the in-plane axes are truncated; the slice axis is left untouched.
     3. Inter-slice Gaps: Simulated via spatial skipping of anatomical data, 
        modeling the loss of tissue information between excitation slabs.
     
@@ -24,12 +112,14 @@ class DegradationSimulator:
         hr_direction (numpy.ndarray): Direction cosine matrix.
     """
 
-    def __init__(self, image_path_or_object):
+    def __init__(self, image_path_or_object, fft_workers=None):
         """
         Initialize the simulator with an ANTsImage or path to NIfTI.
         
         Args:
             image_path_or_object: File path (str) or ants.ANTsImage object.
+            fft_workers (int, optional): Threads used by scipy.fft for k-space
+                truncation (-1 = all cores, None = single-threaded).
         """
         if isinstance(image_path_or_object, str):
             self.image = ants.image_read(image_path_or_object)
@@ -42,6 +132,169 @@ class DegradationSimulator:
         self.hr_origin = self.image.origin
         self.hr_direction = self.image.direction
 
+        self.fft_workers = fft_workers
+
+        # Prefix sums along the slice axis, shared by every thick-slice/gap variant
+        self._cumsum_cache = {}
+        self._data_dtype = None
+        # Forward in-plane spectrum, shared by every in-plane downsample factor
+        self._spectrum_cache = {}
+
+    def _slice_cumsum(self, slice_axis):
+        """
+        Cumulative sum of the volume along `slice_axis` (moved to the last axis),
+        with a leading zero plane: cs[..., j] = sum of slices [0, j).
+        Computed once per axis; every slab average is then a strided difference.
+        """
+        if slice_axis not in self._cumsum_cache:
+            data = np.moveaxis(self.image.numpy(), slice_axis, -1)
+            self._data_dtype = data.dtype
+            cs = np.zeros(data.shape[:-1] + (data.shape[-1] + 1,), dtype=np.float64)
+            np.cumsum(data, axis=-1, dtype=np.float64, out=cs[..., 1:])
+            self._cumsum_cache[slice_axis] = cs
+        return self._cumsum_cache[slice_axis]
+
+    def _slab_average(self, slice_axis, voxels_per_slice, stride):
+        """
+        Averages slabs of `voxels_per_slice` HR slices starting every `stride`
+        slices, keeping only slabs that fit entirely inside the volume.
+
+        Returns:
+            np.ndarray: Volume with one slice per slab, or None if no slab fits.
+        """
+        cs = self._slice_cumsum(slice_axis)
+        dim_size = cs.shape[-1] - 1
+        starts = np.arange(0, dim_size - voxels_per_slice + 1, stride)
+        if starts.size == 0:
+            return None
+        slab_sums = cs[..., starts + voxels_per_slice] - cs[..., starts]
+        data_slabs = (slab_sums / voxels_per_slice).astype(self._data_dtype, copy=False)
+        return np.moveaxis(data_slabs, -1, slice_axis)
+
+    def _slab_average_fractional(self, slice_axis, width, stride):
+        """
+        Exact boxcar averaging over slabs of fractional `width` HR slices starting
+        every `stride` (fractional) slices.
+        
+        The prefix sum is the integral of the piecewise-constant signal sampled
+        at voxel boundaries, so linear interpolation of it gives the integral up
+        to any fractional position, and each slab is still one difference.
+        """
+        cs = self._slice_cumsum(slice_axis)
+        dim_size = cs.shape[-1] - 1
+        n_out = int(np.floor((dim_size - width) / stride + 1e-9)) + 1
+        if n_out < 1:
+            return None
+        starts = np.arange(n_out) * stride
+        slab_sums = self._interp_last_axis(cs, starts + width) - self._interp_last_axis(cs, starts)
+        data_slabs = (slab_sums / width).astype(self._data_dtype, copy=False)
+        return np.moveaxis(data_slabs, -1, slice_axis)
+
+    @staticmethod
+    def _interp_last_axis(values, positions):
+        """Linear interpolation of `values` along its last axis at fractional positions."""
+        lo = np.clip(np.floor(positions).astype(int), 0, values.shape[-1] - 1)
+        hi = np.minimum(lo + 1, values.shape[-1] - 1)
+        frac = positions - lo
+        return values[..., lo] * (1.0 - frac) + values[..., hi] * frac
+
+    def _simulate_slice_profile(self, thickness_mm, gap_mm, profile, slice_axis):
+        """
+        General slice-profile engine for non-integer thickness/gap or non-boxcar
+        profiles. Boxcar slabs are integrated exactly from the prefix sum; other
+        profiles are convolved along the slice axis with an FFT (cost independent
+        of the thickness) and then decimated at the slab centres.
+        
+        Returns:
+            ants.ANTsImage: One slice per slab with spacing thickness + gap.
+        """
+        current_spacing = self.hr_spacing[slice_axis]
+        width = thickness_mm / current_spacing
+        stride = (thickness_mm + gap_mm) / current_spacing
+        
+        if width < 1.0 - 1e-6:
+            raise ValueError("Slice thickness smaller than input resolution.")
+        
+        if profile == 'boxcar':
+            data_final = self._slab_average_fractional(slice_axis, width, stride)
+        else:
+            data = self.image.numpy()
+            dim_size = data.shape[slice_axis]
+            n_out = int(np.floor((dim_size - width) / stride + 1e-9)) + 1
+            if n_out < 1:
+                data_final = None
+            else:
+                # 1. Convolve with the slice profile along the slice axis only.
+                #    Edge-pad first: zero padding would darken the outer slabs.
+                kernel = slice_profile_kernel(profile, width)
+                kernel_shape = [1] * data.ndim
+                kernel_shape[slice_axis] = kernel.size
+                pad = kernel.size // 2 + 1
+                pad_width = [(0, 0)] * data.ndim
+                pad_width[slice_axis] = (pad, pad)
+                smoothed = fftconvolve(
+                    np.pad(data, pad_width, mode='edge'), kernel.reshape(kernel_shape), mode='same', axes=slice_axis
+                )
+                smoothed = np.take(smoothed, np.arange(pad, pad + dim_size), axis=slice_axis)
+                
+                # 2. Decimate: sample each slab centre (fractional HR index)
+                centres = (width - 1.0) / 2.0 + np.arange(n_out) * stride
+                smoothed = np.moveaxis(smoothed, slice_axis, -1)
+                data_final = np.moveaxis(self._interp_last_axis(smoothed, centres), -1, slice_axis)
+                data_final = data_final.astype(data.dtype, copy=False)
+        
+        if data_final is None:
+            raise ValueError("Gap/Thickness settings resulted in no slices (Volume too small).")
+        
+        new_spacing = list(self.hr_spacing)
+        new_spacing[slice_axis] = thickness_mm + gap_mm
+        # First slab centre sits (width - 1) / 2 HR voxels from the first slice
+        new_origin = self._calculate_new_origin(slice_axis, width)
+        
+        return ants.from_numpy(
+            data_final,
+            origin=new_origin,
+            spacing=tuple(new_spacing),
+            direction=self.hr_direction
+        )
+
+    @staticmethod
+    def _is_integer_voxels(value_mm, spacing, tol=1e-3):
+        voxels = value_mm / spacing
+        return abs(voxels - round(voxels)) < tol
+
+    def simulate(self, kind, params):
+        """
+        Dispatches one degradation by kind ('thick_slices', 'inter_slice_gap'
+        or 'in_plane_resolution'), as listed by lr_variant_specs().
+        """
+        if kind == 'thick_slices':
+            return self.simulate_thick_slices(**params)
+        if kind == 'inter_slice_gap':
+            return self.simulate_inter_slice_gap(**params)
+        if kind == 'in_plane_resolution':
+            return self.simulate_in_plane_resolution(**params)
+        raise ValueError(f"Unknown degradation kind: {kind}")
+
+    def simulate_batch(self, sim_cfg):
+        """
+        Generates every variant of a `simulation` config section.
+        
+        All thick-slice and gap variants along an axis are strided differences
+        of a single prefix-sum buffer, so the volume is traversed once instead
+        of once per variant.
+        
+        Args:
+            sim_cfg (dict): The `simulation` section of the pipeline config.
+            
+        Returns:
+            dict: suffix -> ants.ANTsImage, in config order.
+        """
+        return {
+            suffix: self.simulate(kind, params)
+            for suffix, kind, params in lr_variant_specs(sim_cfg)
+        }
+
     def _calculate_new_origin(self, slice_axis, voxels_per_slice):
         """
         Calculates the new physical origin after slice thickening.
@@ -52,7 +305,7 @@ class DegradationSimulator:
         
         Args:
             slice_axis (int): The axis of degradation.
-            voxels_per_slice (int): The downsampling factor.
+            voxels_per_slice (int or float): Slab width in HR voxels (may be fractional).
             
         Returns:
             tuple: The new origin coordinates.
@@ -71,7 +324,7 @@ class DegradationSimulator:
         new_origin = np.array(self.hr_origin) + physical_shift
         return tuple(new_origin)
 
-    def simulate_thick_slices(self, thickness_mm, slice_axis=2):
+    def simulate_thick_slices(self, thickness_mm, slice_axis=2, profile='boxcar'):
         """
         Simulates thick MRI slices by integrating (averaging) signal over the 
         slice thickness. This models the Partial Volume Effect (PVE) accurately 
@@ -80,10 +333,15 @@ class DegradationSimulator:
         This replaces the unrealistic Gaussian blur approach found in general 
         computer vision SISR.
         
+        Thicknesses that are an integer number of HR voxels with a boxcar profile
+        take the fast block-averaging path; fractional thicknesses and gaussian /
+        sinc profiles go through the general slice-profile engine.
+        
         Args:
             thickness_mm (float): Target slice thickness in millimeters.
             slice_axis (int): Axis along which to thicken (0=Sagittal, 1=Coronal, 2=Axial).
                               Default is 2 (Axial z-axis).
+            profile (str): Slice profile, one of SLICE_PROFILES.
                               
         Returns:
             ants.ANTsImage: The simulated thick-slice image (anisotropic).
@@ -91,8 +349,11 @@ class DegradationSimulator:
         current_spacing = self.hr_spacing[slice_axis]
         factor = thickness_mm / current_spacing
         
-        # Strict physics simulation requires integer integration steps for 
-        # perfect boxcar profile. If non-integer, we round to nearest.
+        if profile != 'boxcar' or not self._is_integer_voxels(thickness_mm, current_spacing):
+            if factor >= 1.0 - 1e-6:
+                return self._simulate_slice_profile(thickness_mm, 0.0, profile, slice_axis)
+        
+        # Integer boxcar: block averaging of whole HR slices
         int_factor = int(round(factor))
         
         if int_factor < 1:
@@ -101,33 +362,14 @@ class DegradationSimulator:
             warnings.warn("Target thickness equals input resolution. No degradation applied.")
             return self.image
         
-        data = self.image.numpy()
-        
-        # Handle geometric truncation: The volume might not be perfectly divisible 
-        # by the new thickness. We crop the end to fit integer blocks.
-        dim_size = data.shape[slice_axis]
-        new_dim_size = dim_size // int_factor
-        cutoff = new_dim_size * int_factor
-        
-        # Create slice object to crop data
-        sl = [slice(None)] * data.ndim
-        sl[slice_axis] = slice(0, cutoff)
-        data_cropped = data[tuple(sl)]
-        
         # Vectorized Block Averaging
-        # 1. Move the target axis to the last dimension for easier reshaping
-        data_swapped = np.moveaxis(data_cropped, slice_axis, -1)
-        
-        # 2. Reshape (..., Total_Z) -> (..., New_Z, Factor)
-        temp_shape = list(data_swapped.shape[:-1]) + [new_dim_size, int_factor]
-        data_reshaped = data_swapped.reshape(temp_shape)
-        
-        # 3. Mean over the Factor dimension (Axis -1)
+        # Consecutive, non-overlapping slabs of int_factor slices. The volume
+        # might not be perfectly divisible by the new thickness; trailing
+        # slices that do not fill a whole slab are dropped.
         # This simulates the coil integrating signal from the entire slab.
-        data_thick = data_reshaped.mean(axis=-1)
-        
-        # 4. Move axis back to original position
-        data_final = np.moveaxis(data_thick, -1, slice_axis)
+        data_final = self._slab_average(slice_axis, int_factor, int_factor)
+        if data_final is None:
+            raise ValueError("Target thickness exceeds the volume extent.")
         
         # Update Metadata
         new_spacing = list(self.hr_spacing)
@@ -142,7 +384,7 @@ class DegradationSimulator:
             direction=self.hr_direction
         )
 
-    def simulate_inter_slice_gap(self, thickness_mm, gap_mm, slice_axis=2):
+    def simulate_inter_slice_gap(self, thickness_mm, gap_mm, slice_axis=2, profile='boxcar'):
         """
         Simulates an acquisition with both thick slices and inter-slice gaps.
         
@@ -154,12 +396,19 @@ class DegradationSimulator:
             thickness_mm (float): The thickness of the acquired slab.
             gap_mm (float): The empty space between acquired slabs.
             slice_axis (int): Axis of degradation.
+            profile (str): Slice profile, one of SLICE_PROFILES. Integer voxel
+                thickness/gap with a boxcar profile uses the fast strided path.
             
         Returns:
             ants.ANTsImage: The sparse, thick-slice image with corrected spacing.
         """
         current_spacing = self.hr_spacing[slice_axis]
         
+        if (profile != 'boxcar'
+                or not self._is_integer_voxels(thickness_mm, current_spacing)
+                or not self._is_integer_voxels(gap_mm, current_spacing)):
+            return self._simulate_slice_profile(thickness_mm, gap_mm, profile, slice_axis)
+        
         # Calculate voxel counts for slice and gap
         voxels_per_slice = int(round(thickness_mm / current_spacing))
         voxels_gap = int(round(gap_mm / current_spacing))
@@ -168,29 +417,12 @@ class DegradationSimulator:
         if voxels_per_slice < 1:
             raise ValueError("Slice thickness smaller than input resolution.")
             
-        data = self.image.numpy()
-        dim_size = data.shape[slice_axis]
-        
-        indices = []
-        # Strided Loop: Simulate the acquisition stepping through the volume
-        for start_idx in range(0, dim_size, stride):
-            end_idx = start_idx + voxels_per_slice
-            if end_idx <= dim_size:
-                # Extract the slab
-                sl = [slice(None)] * data.ndim
-                sl[slice_axis] = slice(start_idx, end_idx)
-                slab = data[tuple(sl)]
-                
-                # Integrate (Average) signal in slab -> collapse to 1 slice
-                # keepdims=True maintains 3D structure for concatenation
-                slab_integrated = slab.mean(axis=slice_axis, keepdims=True)
-                indices.append(slab_integrated)
+        # Strided Slab Integration: simulate the acquisition stepping through
+        # the volume, averaging each slab's signal into one slice
+        data_gapped = self._slab_average(slice_axis, voxels_per_slice, stride)
         
-        if not indices:
+        if data_gapped is None:
             raise ValueError("Gap/Thickness settings resulted in no slices (Volume too small).")
-            
-        # Concatenate the acquired slices back into a volume
-        data_gapped = np.concatenate(indices, axis=slice_axis)
         
         # Update Metadata
         # Spacing in dicom/nifti is center-to-center distance.
@@ -208,53 +440,81 @@ class DegradationSimulator:
             direction=self.hr_direction
         )
 
-    def simulate_in_plane_resolution(self, downsample_factor):
+    def _in_plane_spectrum(self, slice_axis):
+        """
+        Forward real FFT over the two in-plane axes only (complex64), computed
+        once per slice axis and reused for every downsample factor.
+        """
+        if slice_axis not in self._spectrum_cache:
+            in_plane_axes = tuple(a for a in range(self.image.dimension) if a != slice_axis)
+            data = self.image.numpy().astype(np.float32, copy=False)
+            # norm='forward' scales by 1/N here so the truncated inverse keeps intensities
+            self._spectrum_cache[slice_axis] = rfftn(
+                data, axes=in_plane_axes, norm='forward', workers=self.fft_workers
+            )
+        return self._spectrum_cache[slice_axis]
+
+    def simulate_in_plane_resolution(self, downsample_factor, slice_axis=2):
         """
         Simulates in-plane resolution reduction via K-space truncation.
         This reproduces Gibbs ringing artifacts associated with low-matrix acquisitions.
         
+        Only the two in-plane axes are transformed and truncated; the slice axis
+        is left untouched. A real-to-complex FFT in single precision keeps the
+        spectrum at roughly the size of the float32 volume.
+        
         Args:
             downsample_factor (int): Factor by which to reduce resolution (e.g., 2).
                                      Applied to the two non-slice axes.
+            slice_axis (int): Axis excluded from truncation. Default is 2 (Axial z-axis).
+        
+        Returns:
+            ants.ANTsImage: Magnitude image on the reduced in-plane matrix.
         """
-        # Identify in-plane axes (assuming z=2 is slice axis for simplicity, 
-        # though this can be generalized)
-        # For this example, we apply to all axes or specify dimensions.
-        # Let's assume isotropic downsampling for this method demonstration.
+        if downsample_factor < 1:
+            raise ValueError("Downsample factor must be >= 1.")
+        if downsample_factor == 1:
+            warnings.warn("Downsample factor of 1. No degradation applied.")
+            return self.image
         
-        data = self.image.numpy()
+        in_plane_axes = tuple(a for a in range(self.image.dimension) if a != slice_axis)
+        full_axis, half_axis = in_plane_axes
         
-        # 1. FFT to K-space
-        # fftshift moves zero-frequency component to center of spectrum
-        kspace = fftshift(fftn(data))
+        # 1. K-space (cached): full spectrum along full_axis, half along half_axis
+        kspace = self._in_plane_spectrum(slice_axis)
         
         # 2. Determine Crop Window (Truncation)
-        center = np.array(kspace.shape) // 2
-        new_dims = np.array(kspace.shape) // downsample_factor
-        new_dims = new_dims.astype(int)
-        
-        start = center - new_dims // 2
-        end = start + new_dims
-        
-        # Crop the high frequencies
-        sl = tuple(slice(s, e) for s, e in zip(start, end))
-        kspace_cropped = kspace[sl]
-        
-        # 3. Inverse FFT
-        # ifftshift moves zero-frequency back to corner before IFFT
-        img_lr_complex = ifftn(ifftshift(kspace_cropped))
-        img_lr = np.abs(img_lr_complex) # Magnitude reconstruction
+        n_full = self.image.shape[full_axis]
+        n_half = self.image.shape[half_axis]
+        new_full = n_full // downsample_factor
+        new_half = n_half // downsample_factor
+        
+        # Keep frequencies -(m//2) .. m - m//2 - 1 along the full axis, stored
+        # in FFT order (non-negative first), i.e. the centred crop of fftshift
+        keep_full = np.r_[0:new_full - new_full // 2, n_full - new_full // 2:n_full]
+        kspace_cropped = np.take(kspace, keep_full, axis=full_axis)
+        # Non-negative frequencies only along the half-spectrum axis
+        sl = [slice(None)] * kspace.ndim
+        sl[half_axis] = slice(0, new_half // 2 + 1)
+        kspace_cropped = kspace_cropped[tuple(sl)]
+        
+        # 3. Inverse FFT onto the smaller matrix
+        img_lr = irfftn(
+            kspace_cropped, s=(new_full, new_half), axes=in_plane_axes,
+            norm='forward', workers=self.fft_workers
+        )
+        img_lr = np.abs(img_lr) # Magnitude reconstruction
         
         # 4. Update Metadata
-        new_spacing = [s * downsample_factor for s in self.hr_spacing]
-        
-        # Note: K-space truncation implicitly centers the field of view, 
-        # but origin handling can be subtle depending on phase encoding centers.
-        # We assume standard centered reconstruction here.
+        new_spacing = list(self.hr_spacing)
+        for axis in in_plane_axes:
+            new_spacing[axis] = self.hr_spacing[axis] * downsample_factor
         
+        # LR sample j is the low-passed signal at HR index j * factor, so the
+        # first voxel centre (and thus the origin) is unchanged.
         return ants.from_numpy(
-            img_lr,
+            img_lr.astype(np.float32, copy=False),
             origin=self.hr_origin,
             spacing=tuple(new_spacing),
             direction=self.hr_direction
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,122 @@
+import os
+import threading
+import ants
+import numpy as np
+
+try:
+    import zarr
+except ImportError:  # Optional: only needed for intermediate_backend 'zarr'
+    zarr = None
+
+# zarr 3 replaced numcodecs compressors and create_dataset() with codecs and create_array()
+ZARR_V3 = zarr is not None and int(zarr.__version__.split('.')[0]) >= 3
+if ZARR_V3:
+    from zarr.codecs import BloscCodec
+elif zarr is not None:
+    from numcodecs import Blosc
+
+
+class ZarrIntermediateStore:
+    """
+    Chunked per-subject store for pipeline intermediates.
+
+    Every step of a subject is one array in <root>/<subject>.zarr, compressed
+    with Blosc (LZ4 or Zstd) in `chunks`-sized blocks, so a slice or ROI
+    decodes only the chunks it touches. Origin, spacing and direction are kept
+    as array attributes; export_nifti() writes a step back out as NIfTI.
+    """
+
+    def __init__(self, root, compressor='lz4', clevel=5, chunks=(64, 64, 64)):
+        """
+        Args:
+            root (str): Directory holding one <subject>.zarr group per subject.
+            compressor (str): Blosc codec, 'lz4' (fastest) or 'zstd' (smaller).
+            clevel (int): Compression level.
+            chunks (tuple): Chunk shape in voxels.
+        """
+        if zarr is None:
+            raise ImportError("intermediate_backend 'zarr' requires the zarr package (pip install zarr)")
+        self.root = root
+        if ZARR_V3:
+            self.compressor = BloscCodec(cname=compressor, clevel=clevel, shuffle='bitshuffle')
+        else:
+            self.compressor = Blosc(cname=compressor, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+        self.chunks = tuple(chunks)
+        # Serializes group creation when LR variants save concurrently
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, filename):
+        base_name = filename.replace('.nii.gz', '').replace('.nii', '')
+        return os.path.join(self.root, f"{base_name}.zarr")
+
+    def _group(self, filename, mode='r'):
+        return zarr.open_group(self.path(filename), mode=mode)
+
+    def save(self, image, filename, step):
+        """Stores an ANTsImage as array `step` of the subject's group."""
+        data = image.numpy()
+        with self._lock:
+            group = self._group(filename, mode='a')
+        chunks = tuple(min(c, s) for c, s in zip(self.chunks, data.shape))
+        if ZARR_V3:
+            array = group.create_array(
+                step, data=data, chunks=chunks, compressors=self.compressor, overwrite=True
+            )
+        else:
+            array = group.create_dataset(
+                step, data=data, chunks=chunks, compressor=self.compressor, overwrite=True
+            )
+        array.attrs.update({
+            'origin': [float(v) for v in image.origin],
+            'spacing': [float(v) for v in image.spacing],
+            'direction': np.asarray(image.direction).tolist(),
+        })
+
+    def steps(self, filename):
+        """Names of the stored steps, sorted (step names start with their pipeline order)."""
+        if not os.path.exists(self.path(filename)):
+            return []
+        return sorted(self._group(filename).array_keys())
+
+    def read(self, filename, step, roi=None):
+        """
+        Reads a step as a numpy array, decoding only the chunks under `roi`.
+
+        Args:
+            roi (tuple, optional): Index expression, e.g. (slice(None), slice(None), 80).
+        """
+        array = self._group(filename)[step]
+        return array[roi if roi is not None else ...]
+
+    def read_slice(self, filename, step, index, axis=2):
+        """Single 2D slice along `axis`."""
+        roi = [slice(None)] * 3
+        roi[axis] = index
+        return self.read(filename, step, tuple(roi))
+
+    def read_image(self, filename, step):
+        """Reads a step back as an ANTsImage with its spatial metadata."""
+        array = self._group(filename)[step]
+        return ants.from_numpy(
+            array[...],
+            origin=tuple(array.attrs['origin']),
+            spacing=tuple(array.attrs['spacing']),
+            direction=np.asarray(array.attrs['direction'])
+        )
+
+    def export_nifti(self, filename, out_dir, steps=None):
+        """
+        Writes steps (default: all) as <out_dir>/<subject>_<step>.nii.gz.
+
+        Returns:
+            list: Written paths.
+        """
+        base_name = filename.replace('.nii.gz', '').replace('.nii', '')
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for step in steps or self.steps(filename):
+            path = os.path.join(out_dir, f"{base_name}_{step}.nii.gz")
+            ants.image_write(self.read_image(filename, step), path)
+            paths.append(path)
+        return paths
@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import threading
+from dataclasses import asdict
+
+
+class BatchJournal:
+    """
+    Append-only JSON-lines record of processed subjects, stored in output_dir.
+
+    Each line holds a subject's PipelineResult together with the input
+    fingerprint and config hash it was produced with. The last record for a
+    subject wins, so a rerun after a crash or preemption can skip subjects that
+    already completed with the same input and configuration.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Truncated last line from an interrupted write
+                    continue
+                self._records[record['subject_filename']] = record
+
+    def is_complete(self, subject_filename, fingerprint, config_hash):
+        """True if the subject finished successfully with this input/config and its outputs still exist."""
+        record = self._records.get(subject_filename)
+        if record is None or record.get('error') is not None:
+            return False
+        if record.get('fingerprint') != fingerprint or record.get('config_hash') != config_hash:
+            return False
+        outputs = [record.get('hr_path')] + list(record.get('lr_paths', {}).values())
+        return all(p and os.path.exists(p) for p in outputs)
+
+    def get(self, subject_filename):
+        return self._records.get(subject_filename)
+
+    def record(self, result, fingerprint, config_hash):
+        """Appends one PipelineResult to the journal and flushes it to disk."""
+        record = asdict(result)
+        record.update({
+            'fingerprint': fingerprint,
+            'config_hash': config_hash,
+            'timestamp': time.time(),
+        })
+        with self._lock:
+            self._records[result.subject_filename] = record
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
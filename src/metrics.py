@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import glob
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then omitted
+    resource = None
+
+
+def new_run_id():
+    """Sortable id of one pipeline run (a batch or a single job)."""
+    return time.strftime('%Y%m%dT%H%M%S') + '-' + uuid.uuid4().hex[:6]
+
+
+def current_rss_bytes():
+    """Current resident set size of this process, or None if unavailable (non-Linux)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return int(peak if sys.platform == 'darwin' else peak * 1024)
+
+
+class StageMetrics:
+    """
+    Per-stage instrumentation for MRIPreprocessingPipeline.
+
+    Each stage() block records wall time, process CPU time, peak RSS and the
+    voxel count of its input as one JSON line in <metrics_dir>/stages-<pid>.jsonl
+    (one file per process, so run_batch workers never interleave writes).
+    Every record carries the id of the run it belongs to (`run_id`; run_batch
+    starts a new run and shares its id with its worker processes), so
+    summaries cover one run rather than everything in the directory.
+    write_prometheus() renders the running per-stage totals of this process to
+    <metrics_dir>/pipeline-<pid>.prom for the node_exporter textfile collector.
+
+    CPU time is process-wide: it includes ITK/torch worker threads, and stages
+    that overlap (concurrent LR variants, background writes) share it. The
+    peak RSS of a stage is the largest process RSS sampled every
+    `rss_interval_s` while it runs (Linux only), so spikes shorter than the
+    interval can be missed; `process_peak_rss_bytes` is the lifetime peak.
+    """
+
+    def __init__(self, metrics_dir, prometheus=True, run_id=None, rss_interval_s=0.05):
+        self.metrics_dir = metrics_dir
+        self.prometheus = prometheus
+        self.run_id = run_id or new_run_id()
+        self.rss_interval_s = rss_interval_s
+        os.makedirs(metrics_dir, exist_ok=True)
+        self._pid = os.getpid()
+        self._jsonl_path = os.path.join(metrics_dir, f"stages-{self._pid}.jsonl")
+        self._lock = threading.Lock()
+        # stage -> [count, wall_sum, cpu_sum, voxel_sum, failures]
+        self._totals = {}
+        # Peak RSS of the running stages (token -> bytes), updated by the sampler thread
+        self._rss_peaks = {}
+        self._sampler = None
+
+    def new_run(self, run_id=None):
+        """Starts a new run; later records carry its id. Returns the id."""
+        self.run_id = run_id or new_run_id()
+        return self.run_id
+
+    def _start_rss(self, token):
+        rss = current_rss_bytes()
+        if rss is None:
+            return
+        with self._lock:
+            self._rss_peaks[token] = rss
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, name='rss-sampler', daemon=True)
+                self._sampler.start()
+
+    def _stop_rss(self, token):
+        rss = current_rss_bytes()
+        with self._lock:
+            peak = self._rss_peaks.pop(token, None)
+        if peak is None:
+            return None
+        return max(peak, rss or 0)
+
+    def _sample_rss(self):
+        """Raises the peak of every running stage; exits when no stage is running."""
+        while True:
+            time.sleep(self.rss_interval_s)
+            rss = current_rss_bytes() or 0
+            with self._lock:
+                if not self._rss_peaks:
+                    self._sampler = None
+                    return
+                for token, peak in self._rss_peaks.items():
+                    if rss > peak:
+                        self._rss_peaks[token] = rss
+
+    @contextmanager
+    def stage(self, subject, stage, voxels=None):
+        """
+        Times the enclosed block. The yielded dict can be updated (e.g. with
+        'voxels' or 'ok') before the block ends; a raised exception is
+        recorded as ok=false and re-raised.
+        """
+        record = {'run_id': self.run_id, 'subject': subject, 'stage': stage, 'voxels': voxels}
+        token = object()
+        self._start_rss(token)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        record['start'] = time.time()
+        ok = True
+        try:
+            yield record
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            record.update({
+                'wall_s': time.perf_counter() - start_wall,
+                'cpu_s': time.process_time() - start_cpu,
+                'peak_rss_bytes': self._stop_rss(token),
+                'process_peak_rss_bytes': peak_rss_bytes(),
+                # The block may mark a handled failure by setting record['ok'] = False
+                'ok': ok and record.get('ok', True),
+            })
+            self.record(record)
+
+    def record(self, record):
+        """Appends one stage record (also usable for externally timed work)."""
+        record = dict(record, pid=self._pid)
+        record.setdefault('run_id', self.run_id)
+        if record.get('voxels') is not None:
+            record['voxels'] = int(record['voxels'])
+        with self._lock:
+            with open(self._jsonl_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            totals = self._totals.setdefault(record['stage'], [0, 0.0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += record.get('wall_s', 0.0)
+            totals[2] += record.get('cpu_s', 0.0)
+            totals[3] += record.get('voxels') or 0
+            totals[4] += 0 if record.get('ok', True) else 1
+
+    def write_prometheus(self):
+        """Writes this process's totals as a Prometheus textfile (atomic replace)."""
+        if not self.prometheus:
+            return
+        with self._lock:
+            totals = {stage: list(values) for stage, values in self._totals.items()}
+        pid = self._pid
+        lines = [
+            "# HELP mri_pipeline_stage_seconds Wall time spent in a pipeline stage.",
+            "# TYPE mri_pipeline_stage_seconds summary",
+        ]
+        for stage, (count, wall, _, _, _) in sorted(totals.items()):
+            lines.append(f'mri_pipeline_stage_seconds_sum{{stage="{stage}",pid="{pid}"}} {wall:.6f}')
+            lines.append(f'mri_pipeline_stage_seconds_count{{stage="{stage}",pid="{pid}"}} {count}')
+        lines += [
+            "# HELP mri_pipeline_stage_cpu_seconds_total Process CPU time spent in a pipeline stage.",
+            "# TYPE mri_pipeline_stage_cpu_seconds_total counter",
+        ]
+        for stage, (_, _, cpu, _, _) in sorted(totals.items()):
+            lines.append(f'mri_pipeline_stage_cpu_seconds_total{{stage="{stage}",pid="{pid}"}} {cpu:.6f}')
+        lines += [
+            "# HELP mri_pipeline_stage_voxels_total Input voxels processed by a pipeline stage.",
+            "# TYPE mri_pipeline_stage_voxels_total counter",
+        ]
+        for stage, (_, _, _, voxels, _) in sorted(totals.items()):
+            lines.append(f'mri_pipeline_stage_voxels_total{{stage="{stage}",pid="{pid}"}} {voxels}')
+        lines += [
+            "# HELP mri_pipeline_stage_failures_total Pipeline stage executions that raised.",
+            "# TYPE mri_pipeline_stage_failures_total counter",
+        ]
+        for stage, (_, _, _, _, failures) in sorted(totals.items()):
+            lines.append(f'mri_pipeline_stage_failures_total{{stage="{stage}",pid="{pid}"}} {failures}')
+        rss = peak_rss_bytes()
+        if rss is not None:
+            lines += [
+                "# HELP mri_pipeline_peak_rss_bytes Peak resident set size of the pipeline process.",
+                "# TYPE mri_pipeline_peak_rss_bytes gauge",
+                f'mri_pipeline_peak_rss_bytes{{pid="{pid}"}} {rss}',
+            ]
+        path = os.path.join(self.metrics_dir, f"pipeline-{pid}.prom")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+def load_metrics(metrics_dir, run_id=None):
+    """
+    Reads the stages-*.jsonl records under `metrics_dir`.
+
+    Args:
+        run_id (str, optional): Only this run; 'latest' selects the run with the
+            most recent record. None reads every run.
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(metrics_dir, 'stages-*.jsonl'))):
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    if run_id == 'latest' and records:
+        run_id = max(records, key=lambda r: r['start']).get('run_id')
+    elif run_id is None:
+        return records
+    return [r for r in records if r.get('run_id') == run_id]
+
+
+def list_runs(records):
+    """Runs in `records`, oldest first: [{'run_id', 'start', 'subjects', 'records'}]."""
+    runs = {}
+    for r in records:
+        run = runs.setdefault(r.get('run_id'), {'run_id': r.get('run_id'), 'start': r['start'],
+                                                'subjects': 0, 'records': 0})
+        run['start'] = min(run['start'], r['start'])
+        run['records'] += 1
+        run['subjects'] += r['stage'] == 'subject'
+    return sorted(runs.values(), key=lambda run: run['start'])
+
+
+def summarize_metrics(records, percentiles=(50, 90, 99)):
+    """
+    Per-stage percentiles and batch throughput from stage records.
+
+    Stage names are grouped by their prefix before ':' (e.g. all
+    'lr:thick_3mm', 'lr:gap_...' records form 'lr'). Elapsed time is the
+    span from the first to the last subject of each run, summed over runs,
+    so idle time between runs is never counted.
+
+    Returns:
+        dict: {'stages': {stage: {'count', 'failures', 'wall_p<N>', 'cpu_mean',
+        'peak_rss_max_bytes', 'mvoxels_per_s'}}, 'runs', 'subjects',
+        'failed_subjects', 'elapsed_h', 'subjects_per_hour'}
+    """
+    groups = {}
+    for r in records:
+        groups.setdefault(r['stage'].split(':', 1)[0], []).append(r)
+
+    stages = {}
+    for stage, rs in sorted(groups.items()):
+        wall = np.array([r['wall_s'] for r in rs])
+        summary = {'count': len(rs), 'failures': sum(1 for r in rs if not r.get('ok', True))}
+        for p, value in zip(percentiles, np.percentile(wall, percentiles)):
+            summary[f'wall_p{p}'] = float(value)
+        summary['cpu_mean'] = float(np.mean([r['cpu_s'] for r in rs]))
+        rss = [r['peak_rss_bytes'] for r in rs if r.get('peak_rss_bytes') is not None]
+        summary['peak_rss_max_bytes'] = max(rss) if rss else None
+        voxels = sum(r.get('voxels') or 0 for r in rs)
+        summary['mvoxels_per_s'] = voxels / wall.sum() / 1e6 if voxels and wall.sum() > 0 else None
+        stages[stage] = summary
+
+    subjects = [r for r in records if r['stage'] == 'subject']
+    result = {
+        'stages': stages,
+        'runs': [run['run_id'] for run in list_runs(records)],
+        'subjects': len(subjects),
+        'failed_subjects': sum(1 for r in subjects if not r.get('ok', True)),
+        'elapsed_h': None,
+        'subjects_per_hour': None,
+    }
+    if subjects:
+        # Wall-clock span of each run, covering all its worker processes
+        spans = {}
+        for r in subjects:
+            start, end = spans.get(r.get('run_id'), (r['start'], r['start'] + r['wall_s']))
+            spans[r.get('run_id')] = (min(start, r['start']), max(end, r['start'] + r['wall_s']))
+        elapsed_h = sum(end - start for start, end in spans.values()) / 3600.0
+        result['elapsed_h'] = elapsed_h
+        result['subjects_per_hour'] = len(subjects) / elapsed_h if elapsed_h > 0 else None
+    return result
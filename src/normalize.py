@@ -1,26 +1,226 @@
+import os
+import json
 import ants
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from intensity_normalization.normalize.whitestripe import WhiteStripeNormalize
 from intensity_normalization.typing import Modality
 from.utils import ants_to_numpy, numpy_to_ants
 
+# Nyúl landmark percentiles: pmin, deciles, pmax
+NYUL_DEFAULT_PERCENTILES = (1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 99)
+
+
+def nyul_image_landmarks(data, percentiles=NYUL_DEFAULT_PERCENTILES):
+    """
+    Intensity landmarks of one image: the given percentiles of its foreground
+    (voxels above the image mean, as in intensity-normalization's default mask).
+    """
+    foreground = data[data > data.mean()]
+    if foreground.size == 0:
+        raise ValueError("image has no foreground voxels")
+    return np.percentile(foreground, percentiles).astype(np.float64)
+
+
+def _nyul_map_landmarks(landmarks, output_range):
+    """Linearly maps [pmin, pmax] of one image's landmarks onto output_range."""
+    lo, hi = output_range
+    span = landmarks[-1] - landmarks[0]
+    if span <= 0:
+        raise ValueError("degenerate landmarks (pmin == pmax)")
+    return lo + (landmarks - landmarks[0]) / span * (hi - lo)
+
+
+@dataclass
+class NyulLandmarks:
+    """
+    Streaming estimate of the Nyúl & Udupa standard histogram scale.
+
+    Each image contributes its landmarks mapped onto `output_range`; the
+    standard scale is their mean. Only the running sum and count are kept, so
+    partial fits from different workers (or cohorts) merge by addition.
+    """
+    percentiles: tuple = NYUL_DEFAULT_PERCENTILES
+    output_range: tuple = (1.0, 100.0)
+    landmark_sum: np.ndarray = None
+    n_images: int = 0
+    failed: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self.percentiles = tuple(float(p) for p in self.percentiles)
+        self.output_range = tuple(float(v) for v in self.output_range)
+        if self.landmark_sum is None:
+            self.landmark_sum = np.zeros(len(self.percentiles))
+        self.landmark_sum = np.asarray(self.landmark_sum, dtype=np.float64)
+
+    def update(self, data):
+        """Adds one image (numpy array) to the estimate."""
+        landmarks = nyul_image_landmarks(data, self.percentiles)
+        self.landmark_sum += _nyul_map_landmarks(landmarks, self.output_range)
+        self.n_images += 1
+
+    def merge(self, other):
+        """Adds a partial estimate fitted with the same settings."""
+        if other.percentiles != self.percentiles or other.output_range != self.output_range:
+            raise ValueError("Cannot merge Nyúl landmarks fitted with different settings")
+        self.landmark_sum += other.landmark_sum
+        self.n_images += other.n_images
+        self.failed.extend(other.failed)
+        return self
+
+    @property
+    def standard_scale(self):
+        if self.n_images == 0:
+            raise ValueError("Nyúl landmarks were fitted on no images")
+        return self.landmark_sum / self.n_images
+
+    def save(self, path):
+        """Writes the landmark index as JSON."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        index = {
+            'percentiles': list(self.percentiles),
+            'output_range': list(self.output_range),
+            'landmark_sum': self.landmark_sum.tolist(),
+            'n_images': self.n_images,
+            'standard_scale': self.standard_scale.tolist(),
+        }
+        with open(path, 'w') as f:
+            json.dump(index, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            index = json.load(f)
+        return cls(
+            percentiles=index['percentiles'],
+            output_range=index['output_range'],
+            landmark_sum=index['landmark_sum'],
+            n_images=index['n_images'],
+        )
+
+
+def _fit_nyul_partial(paths, percentiles, output_range, load=None):
+    """Worker: partial Nyúl estimate over a chunk of image files."""
+    partial = NyulLandmarks(percentiles=percentiles, output_range=output_range)
+    for path in paths:
+        try:
+            partial.update(load(path) if load is not None else ants.image_read(path).numpy())
+        except Exception as e:
+            partial.failed.append((path, str(e)))
+    return partial
+
+
+def fit_nyul_landmarks(paths, percentiles=NYUL_DEFAULT_PERCENTILES, output_range=(1.0, 100.0), workers=1,
+                       load=None):
+    """
+    Learns the Nyúl standard scale over a cohort in one streaming pass.
+
+    Images are read one at a time (only the landmarks are kept), split into
+    one chunk per worker process, and the partial estimates are merged.
+
+    Args:
+        paths (list): NIfTI files to fit on.
+        percentiles (sequence): Landmark percentiles; the first and last are pmin/pmax.
+        output_range (tuple): Standard scale range that [pmin, pmax] is mapped onto.
+        workers (int): Number of worker processes.
+        load (callable, optional): path -> numpy array of the image to fit on
+            (default: the file as is). Must be picklable when workers > 1, e.g.
+            the pipeline's normalization input (see load_normalization_input).
+
+    Returns:
+        NyulLandmarks: Merged estimate. Unreadable images are listed in `failed`.
+    """
+    workers = max(1, min(int(workers), len(paths) or 1))
+    if workers == 1:
+        return _fit_nyul_partial(list(paths), percentiles, output_range, load)
+    chunks = [list(paths[i::workers]) for i in range(workers)]
+    result = NyulLandmarks(percentiles=percentiles, output_range=output_range)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(_fit_nyul_partial, chunks, [percentiles] * workers,
+                                    [output_range] * workers, [load] * workers):
+            result.merge(partial)
+    return result
+
+
+def _piecewise_linear(data, xp, fp):
+    """np.interp with linear extrapolation beyond the first/last landmark."""
+    out = np.interp(data, xp, fp)
+    below = data < xp[0]
+    above = data > xp[-1]
+    out[below] = fp[0] + (data[below] - xp[0]) * (fp[1] - fp[0]) / (xp[1] - xp[0])
+    out[above] = fp[-1] + (data[above] - xp[-1]) * (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+    return out
+
+
 class IntensityNormalizer:
-    def __init__(self, method='whitestripe', modality='T1'):
+    def __init__(self, method='whitestripe', modality='T1', nyul_landmarks=None):
+        """
+        Args:
+            method (str): 'whitestripe', 'zscore' or 'nyul'.
+            modality (str): Image modality for WhiteStripe.
+            nyul_landmarks (NyulLandmarks or str, optional): Fitted landmarks (or
+                the path of their index file); required for 'nyul'.
+        """
         self.method = method
         self.modality = modality
+        if isinstance(nyul_landmarks, str):
+            nyul_landmarks = NyulLandmarks.load(nyul_landmarks)
+        self.nyul_landmarks = nyul_landmarks
+        if method == 'nyul' and nyul_landmarks is None:
+            raise ValueError("Nyúl normalization requires fitted landmarks (see fit_nyul_landmarks)")
 
-    def apply(self, image: ants.ANTsImage) -> ants.ANTsImage:
+    def apply(self, image: ants.ANTsImage, params: dict = None) -> ants.ANTsImage:
         """
         Applies intensity normalization to an ANTsImage.
+
+        Args:
+            image: Image to normalize.
+            params (dict, optional): Parameters from fit() on another image (e.g. the
+                HR scan of the same subject). If None, they are fitted on `image`.
+        """
+        if params is None:
+            params = self.fit(image)
+        return self._apply_params(image, params)
+
+    def fit(self, image: ants.ANTsImage) -> dict:
+        """
+        Estimates the normalization parameters of an image without applying them.
+
+        Returns:
+            dict: {'method', 'location', 'scale'} describing the affine intensity
+            map (image - location) / scale, or for 'nyul' the image's
+            'landmarks' and the cohort 'standard' scale they map onto.
         """
         if self.method == 'whitestripe':
-            return self._apply_whitestripe(image)
+            return self._fit_whitestripe(image)
         elif self.method == 'zscore':
-            return self._zscore(image)
+            return self._fit_zscore(image)
+        elif self.method == 'nyul':
+            return self._fit_nyul(image)
         else:
             raise ValueError(f"Unknown normalization method: {self.method}")
 
-    def _apply_whitestripe(self, image):
+    def _apply_params(self, image, params):
+        if params['method'] == 'identity':
+            return image # Nothing to normalize (empty image)
+        img_np = image.numpy()
+        if params['method'] == 'whitestripe':
+            # WhiteStripe maps every voxel with the same affine transform
+            norm_np = (img_np - params['location']) / params['scale']
+        elif params['method'] == 'zscore':
+            mask = img_np > 0
+            norm_np = np.zeros_like(img_np)
+            norm_np[mask] = (img_np[mask] - params['location']) / (params['scale'] + 1e-8)
+        elif params['method'] == 'nyul':
+            norm_np = _piecewise_linear(
+                img_np.astype(np.float64), np.asarray(params['landmarks']), np.asarray(params['standard'])
+            ).astype(img_np.dtype, copy=False)
+        else:
+            raise ValueError(f"Unknown normalization parameters: {params['method']}")
+        return numpy_to_ants(norm_np, image)
+
+    def _fit_whitestripe(self, image):
         try:
             # Convert to numpy for the normalization library
             img_np = ants_to_numpy(image)
@@ -29,34 +229,49 @@ class IntensityNormalizer:
             # The library estimates the white matter peak automatically.
             ws_norm = WhiteStripeNormalize()
             
-            # Apply normalization. Note: explicit masking helps if available,
-            # but the algorithm is robust enough to estimate foreground.
+            # Explicit masking helps if available, but the algorithm is robust
+            # enough to estimate foreground.
             if isinstance(self.modality, str):
                 modality_enum = getattr(Modality, self.modality)
             else:
                 modality_enum = self.modality
-                
-            normalized_np = ws_norm(img_np, modality=modality_enum)
             
-            # Convert back to ANTs, preserving spatial metadata
-            return numpy_to_ants(normalized_np, image)
+            # Locate the white-matter stripe, then read off its mean/std: the
+            # same location/scale WhiteStripeNormalize.__call__ would apply.
+            ws_norm.setup(img_np, modality=modality_enum)
+            try:
+                location = float(ws_norm.calculate_location(img_np, modality=modality_enum))
+                scale = float(ws_norm.calculate_scale(img_np, modality=modality_enum))
+            finally:
+                ws_norm.teardown()
+            if not np.isfinite(scale) or scale <= 0:
+                raise ValueError(f"degenerate white stripe (std={scale})")
+            return {'method': 'whitestripe', 'location': location, 'scale': scale}
             
         except Exception as e:
             print(f"WARNING: WhiteStripe normalization failed ({e}). Falling back to Z-score.")
-            return self._zscore(image)
+            return self._fit_zscore(image)
             
-    def _zscore(self, image):
+    def _fit_zscore(self, image):
         """Standard Z-score normalization with background masking."""
         img_np = image.numpy()
         # Calculate stats only on non-zero pixels to avoid background bias
         mask = img_np > 0
         if np.sum(mask) == 0:
-            return image # Return original if empty
+            return {'method': 'identity'} # Return original if empty
             
         mu = np.mean(img_np[mask])
         sigma = np.std(img_np[mask])
-        
-        norm_np = np.zeros_like(img_np)
-        norm_np[mask] = (img_np[mask] - mu) / (sigma + 1e-8)
-        
-        return numpy_to_ants(norm_np, image)
\ No newline at end of file
+        return {'method': 'zscore', 'location': float(mu), 'scale': float(sigma)}
+
+    def _fit_nyul(self, image):
+        """Landmarks of this image paired with the cohort standard scale."""
+        landmarks = nyul_image_landmarks(image.numpy(), self.nyul_landmarks.percentiles)
+        # Ties (e.g. a flat foreground) would make the lookup non-increasing
+        if np.any(np.diff(landmarks) <= 0):
+            landmarks = landmarks + np.arange(landmarks.size) * 1e-6
+        return {
+            'method': 'nyul',
+            'landmarks': landmarks.tolist(),
+            'standard': self.nyul_landmarks.standard_scale.tolist(),
+        }
@@ -1,12 +1,33 @@
 import os
+import time
+import queue
+import itertools
+import fnmatch
+import contextlib
+import collections
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 import ants
+import numpy as np
 import yaml
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 from .normalize import IntensityNormalizer
-from .degradation import DegradationSimulator
-from .brain_extraction import BrainExtractor
-from .utils import setup_logger
+from .degradation import DegradationSimulator, lr_variant_specs
+from .brain_extraction import BrainExtractor, BrainMaskCache
+from .journal import BatchJournal
+from .stage_cache import StageGraph, StageCache, SubjectStages
+from .transform_store import TransformStore
+from .writer import AsyncImageWriter, WriteError, codec_path, write_image
+from .intermediate_store import ZarrIntermediateStore
+from .metrics import StageMetrics
+from .profiling import StageProfiler
+from .utils import (
+    setup_logger, set_log_file, numpy_to_ants, crop_to_mask, crop_to_box, mask_bounding_box,
+    file_fingerprint, get_config_value, hash_config
+)
 
 
 @dataclass
@@ -16,44 +37,206 @@ class PipelineResult:
     hr_path: str
     lr_paths: Dict[str, str] = field(default_factory=dict)
     error: Optional[str] = None
+    # Intensity normalization fitted on the HR image (see IntensityNormalizer.fit)
+    normalization_params: Optional[Dict[str, Any]] = None
 
     @property
     def success(self) -> bool:
         return self.error is None
 
 
+# ants.registration keyword arguments a registration preset may set
+# (registration.presets in the config). ANTsPy fixes the affine convergence
+# window (1e-6 over 10 iterations), so the iteration caps bound each level.
+REGISTRATION_PRESET_KEYS = (
+    'aff_shrink_factors', 'aff_smoothing_sigmas', 'aff_iterations', 'aff_metric',
+    'aff_sampling', 'aff_random_sampling_rate', 'reg_iterations', 'grad_step', 'random_seed',
+)
+
+
+# Config sections whose values change pipeline outputs (used for resume checks),
+# including the options that decide which files are written and their names
+OUTPUT_CONFIG_KEYS = (
+    'paths.template_path', 'paths.template_mask_path', 'preprocessing', 'simulation',
+    'pipeline_options.output_codec', 'pipeline_options.save_intermediates',
+    'pipeline_options.intermediate_steps', 'pipeline_options.intermediate_codec',
+    'pipeline_options.intermediate_backend', 'pipeline_options.intermediate_compressor',
+    'pipeline_options.save_transforms',
+)
+
+
+@dataclass
+class BatchSummary:
+    """Aggregated outcome of run_batch() across all subjects."""
+    results: List[PipelineResult] = field(default_factory=list)
+    # Subjects skipped because the journal shows them already completed
+    skipped: List[str] = field(default_factory=list)
+    workers: int = 1
+    elapsed_s: float = 0.0
+    # Metrics run id of this batch (see metrics_report.py --run), if metrics are enabled
+    run_id: Optional[str] = None
+
+    @property
+    def succeeded(self) -> List[PipelineResult]:
+        return [r for r in self.results if r.success]
+
+    @property
+    def failed(self) -> List[PipelineResult]:
+        return [r for r in self.results if not r.success]
+
+
+@dataclass
+class _HRReference:
+    """HR-path outputs shared by every LR variant of a subject."""
+    hr_final: ants.ANTsImage
+    # HR->MNI `fwdtransforms`, reused for LR variants when registration.lr_mode is 'reuse_hr'
+    transforms: List[str] = field(default_factory=list)
+    # N4 bias field estimated on the HR image (bias_correction.lr_mode 'reuse_hr_field')
+    bias_field: Optional[ants.ANTsImage] = None
+    # Normalization parameters fitted on the HR image (normalization.lr_mode 'reuse_hr')
+    norm_params: Optional[Dict[str, Any]] = None
+    # Persisted transform entries ('hr' and per-variant 'lr'), see TransformStore
+    transform_entries: Dict[str, Any] = field(default_factory=dict)
+
+
+# Per-process pipeline used by run_batch() workers. Built once by
+# _init_batch_worker so the MNI template and HD-BET predictor are loaded
+# a single time per worker rather than once per subject.
+_worker_pipeline = None
+
+# Each pipeline logs through its own 'preproc.<n>' logger, so pooled instances
+# serving concurrent jobs write to their own job's log file
+_logger_ids = itertools.count()
+
+
+def _init_batch_worker(config_path, output_dir, log_path, itk_threads, run_id=None):
+    global _worker_pipeline
+    # Split the cores between workers so ITK/ANTs and torch do not
+    # oversubscribe the machine (each library defaults to all cores).
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(itk_threads)
+    os.environ['OMP_NUM_THREADS'] = str(itk_threads)
+    try:
+        import torch
+        torch.set_num_threads(itk_threads)
+    except ImportError:
+        pass
+    _worker_pipeline = MRIPreprocessingPipeline(
+        config_path=config_path,
+        output_dir=output_dir,
+        log_path=log_path,
+    )
+    if _worker_pipeline.metrics is not None:
+        # Workers record their stages under the parent's batch run
+        _worker_pipeline.metrics.new_run(run_id)
+
+
+def _process_in_worker(nifti_path: str) -> PipelineResult:
+    return _worker_pipeline.process_subject(nifti_path)
+
+
+# Per-process pipelines used by load_normalization_input, by config path
+_normalization_input_pipelines = {}
+
+
+def load_normalization_input(config_path: str, nifti_path: str) -> np.ndarray:
+    """
+    MRIPreprocessingPipeline.normalization_input() of `nifti_path` as a numpy
+    array, for fit_nyul_landmarks(load=...). Bind the config with
+    functools.partial; the pipeline is built once per (worker) process.
+    """
+    pipeline = _normalization_input_pipelines.get(config_path)
+    if pipeline is None:
+        pipeline = MRIPreprocessingPipeline(config_path, prenormalization_only=True)
+        _normalization_input_pipelines[config_path] = pipeline
+    return pipeline.normalization_input(nifti_path).numpy()
+
+
 class MRIPreprocessingPipeline:
-    def __init__(self, config_path: str, output_dir: str = None, log_path: str = None):
+    def __init__(self, config_path: str, output_dir: str = None, log_path: str = None,
+                 prenormalization_only: bool = False):
+        self.config_path = config_path
+        self.log_path = log_path
         with open(config_path, 'r') as f:
             self.cfg = yaml.safe_load(f)
+        self._config_output_dir = self.cfg['paths']['output_dir']
 
         # Allow caller to override output dir (e.g., per-job output in backend)
         if output_dir:
             self.cfg['paths']['output_dir'] = output_dir
 
         log_file = log_path or 'pipeline.log'
-        self.logger = setup_logger('preproc', log_file)
+        self.logger = setup_logger(f'preproc.{next(_logger_ids)}', log_file)
         
         # Load Template
         self.logger.info(f"Loading Template: {self.cfg['paths']['template_path']}")
         self.mni_template = ants.image_read(self.cfg['paths']['template_path'])
+        self._load_template_mask()
         
         # Initialize Modules
         # Brain Extractor (if enabled)
         if self.cfg['preprocessing'].get('brain_extraction', {}).get('enabled', False):
+            be_cfg = self.cfg['preprocessing']['brain_extraction']
+            mask_cache = None
+            if be_cfg.get('cache', {}).get('enabled', False):
+                mask_cache = BrainMaskCache(
+                    cache_dir=be_cfg['cache'].get('dir', os.path.join(self.cfg['paths']['output_dir'], ".hdbet_cache")),
+                    max_size_gb=be_cfg['cache'].get('max_size_gb', 20)
+                )
             self.brain_extractor = BrainExtractor(
-                device=self.cfg['preprocessing']['brain_extraction'].get('device', 'cpu'),
-                disable_tta=self.cfg['preprocessing']['brain_extraction'].get('disable_tta', True),
-                keep_mask=self.cfg['preprocessing']['brain_extraction'].get('keep_mask', True)
+                device=be_cfg.get('device', 'cpu'),
+                disable_tta=be_cfg.get('disable_tta', True),
+                keep_mask=be_cfg.get('keep_mask', True),
+                cache=mask_cache,
+                in_memory=be_cfg.get('in_memory', False)
             )
         else:
             self.brain_extractor = None
         
-        self.normalizer = IntensityNormalizer(
-            method=self.cfg['preprocessing']['normalization']['method']
-        )
+        norm_cfg = self.cfg['preprocessing']['normalization']
+        landmarks_path = norm_cfg.get('nyul', {}).get('landmarks_path') if norm_cfg['method'] == 'nyul' else None
+        if prenormalization_only:
+            # Only normalization_input() is used (e.g. to fit the landmarks themselves)
+            self.normalizer = None
+            landmarks_path = None
+        else:
+            self.normalizer = IntensityNormalizer(
+                method=norm_cfg['method'],
+                # Cohort landmarks from `main.py --fit-nyul` (only used by 'nyul')
+                nyul_landmarks=landmarks_path
+            )
+        # Contents of files the config points to, for the stage cache and journal
+        # keys: re-running --fit-nyul to the same path must invalidate normalize
+        self.config_file_digests = {}
+        if landmarks_path:
+            self.config_file_digests['preprocessing.normalization.nyul.landmarks_path'] = file_fingerprint(landmarks_path)
         # DegradationSimulator is now instantiated per-subject in process_subject
         
+        # NIfTI codecs and the optional background writer (see src/writer.py)
+        options = self.cfg.get('pipeline_options', {})
+        self.output_codec = options.get('output_codec', 'gzip')
+        self.intermediate_codec = options.get('intermediate_codec', 'gzip')
+        if options.get('async_writes', False) and not prenormalization_only:
+            self.writer = AsyncImageWriter(max_pending=options.get('write_queue_size', 8))
+        else:
+            self.writer = None
+
+        # Stage keys for the content-addressed stage cache
+        self.stage_graph = StageGraph(self.cfg, file_digests=self.config_file_digests)
+        self._configure_outputs(output_dir)
+        if prenormalization_only:
+            # Of a landmark fit, only the stage cache entries are kept
+            self.save_intermediates = False
+            self.metrics = None
+            self.profiler = None
+
+    def _configure_outputs(self, output_dir=None):
+        """
+        Points the pipeline at an output directory (None = the config's
+        output_dir) and prepares the directories and stores that live there.
+        PipelinePool calls this when handing a warm instance to a new job.
+        """
+        self.cfg['paths']['output_dir'] = output_dir or self._config_output_dir
+
         # Prepare Output Dirs
         self.hr_dir = os.path.join(self.cfg['paths']['output_dir'], "HR")
         self.lr_dir = os.path.join(self.cfg['paths']['output_dir'], "LR")
@@ -61,211 +244,1090 @@ class MRIPreprocessingPipeline:
         os.makedirs(self.lr_dir, exist_ok=True)
 
         # Intermediate Outputs
+        # True, False or 'on_failure' (buffer in memory, write only if the subject fails)
         self.save_intermediates = self.cfg.get('pipeline_options', {}).get('save_intermediates', False)
+        if self.save_intermediates not in (True, False, 'on_failure'):
+            raise ValueError(f"Unknown save_intermediates mode: {self.save_intermediates}")
+        # Step allow-list (fnmatch patterns, e.g. '05_hr_registered_mni', '*_05_reg'):
+        # the only steps saved with True, always written with 'on_failure'
+        self.intermediate_steps = self.cfg.get('pipeline_options', {}).get('intermediate_steps') or []
+        self._intermediate_buffer = collections.deque(
+            maxlen=max(1, int(self.cfg.get('pipeline_options', {}).get('intermediate_buffer_size', 12)))
+        )
+        # Intermediate files written (or queued) for the current subject
+        self._written_intermediates = set()
         self.intermediate_dir = self.cfg['paths'].get('intermediate_dir', os.path.join(self.cfg['paths']['output_dir'], "intermediate"))
         if self.save_intermediates:
             os.makedirs(self.intermediate_dir, exist_ok=True)
+        # 'nifti': one file per step; 'zarr': one chunked store per subject
+        options = self.cfg.get('pipeline_options', {})
+        self.intermediate_backend = options.get('intermediate_backend', 'nifti')
+        if self.save_intermediates and self.intermediate_backend == 'zarr':
+            self.intermediate_store = ZarrIntermediateStore(
+                self.intermediate_dir,
+                compressor=options.get('intermediate_compressor', 'lz4'),
+            )
+        elif self.intermediate_backend in ('nifti', 'zarr'):
+            self.intermediate_store = None
+        else:
+            raise ValueError(f"Unknown intermediate_backend: {self.intermediate_backend}")
+
+        # Content-addressed stage cache for incremental reruns
+        if self.cfg.get('pipeline_options', {}).get('stage_cache', False):
+            cache_dir = self.cfg['paths'].get('cache_dir', os.path.join(self.cfg['paths']['output_dir'], ".stage_cache"))
+            self.stage_cache = StageCache(
+                cache_dir,
+                max_size_gb=self.cfg.get('pipeline_options', {}).get('stage_cache_max_size_gb', 50),
+                codec=self.intermediate_codec,
+            )
+        else:
+            self.stage_cache = None
+
+        # Per-stage timing/memory metrics (JSON lines + Prometheus textfile)
+        metrics_cfg = self.cfg.get('pipeline_options', {}).get('metrics', {})
+        if metrics_cfg.get('enabled', False):
+            self.metrics = StageMetrics(
+                metrics_cfg.get('dir') or os.path.join(self.cfg['paths']['output_dir'], "metrics"),
+                prometheus=metrics_cfg.get('prometheus', True),
+                rss_interval_s=metrics_cfg.get('rss_interval_s', 0.05),
+            )
+        else:
+            self.metrics = None
+        # Opt-in CPU profiles of selected stages (one file per subject and stage)
+        profiling_cfg = self.cfg.get('pipeline_options', {}).get('profiling', {})
+        if profiling_cfg.get('enabled', False):
+            self.profiler = StageProfiler(
+                profiling_cfg.get('dir') or os.path.join(self.cfg['paths']['output_dir'], "profiles"),
+                profiler=profiling_cfg.get('profiler', 'cprofile'),
+                stages=profiling_cfg.get('stages'),
+                interval=profiling_cfg.get('interval', 0.001),
+            )
+        else:
+            self.profiler = None
+        self._current_subject = None
+
+        # Registration transforms kept for reapply()
+        if self.cfg.get('pipeline_options', {}).get('save_transforms', True):
+            self.transform_store = TransformStore(os.path.join(self.cfg['paths']['output_dir'], "transforms"))
+        else:
+            self.transform_store = None
+
+    def _load_template_mask(self):
+        """
+        Loads paths.template_mask_path once and prepares the registration target:
+        the template cropped to the mask bounding box (+ margin) and the cropped
+        mask, which restricts the similarity metric to brain voxels. Transforms
+        are physical, so outputs are still resampled onto the full template grid.
+        """
+        reg_cfg = self.cfg['preprocessing']['registration']
+        mask_path = self.cfg['paths'].get('template_mask_path')
+        self.registration_template = self.mni_template
+        self.template_mask = None
+        self._template_box = None
+        if not reg_cfg.get('use_template_mask', True) or not mask_path:
+            return
+        if not os.path.exists(mask_path):
+            self.logger.warning(f"Template mask not found ({mask_path}); registering against the full template")
+            return
+
+        self.logger.info(f"Loading Template Mask: {mask_path}")
+        mask = ants.image_read(mask_path)
+        if mask.shape != self.mni_template.shape:
+            mask = ants.resample_image_to_target(mask, self.mni_template, interp_type='nearestNeighbor')
+        mask = numpy_to_ants((mask.numpy() > 0).astype(np.float32), self.mni_template)
+
+        margin_mm = reg_cfg.get('template_crop_margin_mm', 10)
+        margin_vox = [int(np.ceil(float(margin_mm) / s)) for s in self.mni_template.spacing]
+        box = mask_bounding_box(mask.numpy(), margin_vox)
+        if box is None:
+            self.logger.warning("Template mask is empty; registering against the full template")
+            return
+        self._template_box = box
+        self.registration_template = crop_to_box(self.mni_template, *box)
+        self.template_mask = crop_to_box(mask, *box)
+        self.logger.info(
+            f"Registration template cropped to mask: {int(np.prod(self.mni_template.shape))} -> "
+            f"{int(np.prod(self.registration_template.shape))} voxels"
+        )
+
+    def registration_kwargs(self, preset=None, for_lr=False):
+        """
+        ants.registration keyword arguments for a named preset.
+
+        Args:
+            preset (str, optional): Name in registration.presets. Defaults to
+                registration.preset; None or 'default' keeps the ANTsPy defaults.
+            for_lr (bool): LR -> HR registration. Pyramid levels with a shrink
+                factor below the preset's `lr_min_shrink` are dropped, since the
+                moving LR image carries no detail at full HR resolution.
+
+        Returns:
+            dict: Keyword arguments for ants.registration.
+        """
+        reg_cfg = self.cfg['preprocessing']['registration']
+        preset = preset or reg_cfg.get('preset')
+        if not preset or preset == 'default':
+            return {}
+        presets = reg_cfg.get('presets', {})
+        if preset not in presets:
+            raise ValueError(f"Unknown registration preset: {preset}")
+        kwargs = {k: v for k, v in presets[preset].items() if k in REGISTRATION_PRESET_KEYS}
+
+        shrink = kwargs.get('aff_shrink_factors')
+        lr_min_shrink = presets[preset].get('lr_min_shrink', 1)
+        if for_lr and shrink and lr_min_shrink > 1:
+            keep = [i for i, f in enumerate(shrink) if f >= lr_min_shrink] or [0]
+            for k in ('aff_shrink_factors', 'aff_smoothing_sigmas', 'aff_iterations'):
+                if k in kwargs:
+                    kwargs[k] = [kwargs[k][i] for i in keep]
+        # ANTsPy expects tuples for the multi-resolution schedules
+        return {k: tuple(v) if isinstance(v, list) else v for k, v in kwargs.items()}
+
+    def _registration_target(self, image):
+        """Crops an image on the template grid (e.g. the HR result) to the registration box."""
+        if self._template_box is None:
+            return image
+        return crop_to_box(image, *self._template_box)
+
+    @contextlib.contextmanager
+    def _stage(self, stage, image=None):
+        """
+        Metrics and profiling context for one stage of the current subject
+        (a no-op when both are disabled). `image` is the stage input, for
+        voxel counts. Yields the metrics record.
+        """
+        if self.metrics is None:
+            metrics = contextlib.nullcontext({})
+        else:
+            voxels = int(np.prod(image.shape)) if image is not None else None
+            metrics = self.metrics.stage(self._current_subject, stage, voxels)
+        if self.profiler is None:
+            profile = contextlib.nullcontext()
+        else:
+            profile = self.profiler.profile(self._current_subject, stage)
+        with metrics as record, profile:
+            yield record
 
     def _save_intermediate(self, image, subject_filename, step_suffix):
         if not self.save_intermediates:
             return
-            
+        if self._writes_intermediate(step_suffix):
+            self._write_intermediate(image, subject_filename, step_suffix)
+        elif self.save_intermediates == 'on_failure':
+            # Held until the subject fails (see _flush_intermediate_buffer); the ring
+            # buffer keeps the most recent steps, i.e. those leading to the failure
+            self._intermediate_buffer.append((image, subject_filename, step_suffix))
+
+    def _writes_intermediate(self, step_suffix):
+        """Whether `step_suffix` is written as soon as it is produced."""
+        allowed = any(fnmatch.fnmatchcase(step_suffix, pattern) for pattern in self.intermediate_steps)
+        if self.save_intermediates == 'on_failure':
+            return allowed
+        return bool(self.save_intermediates) and (allowed or not self.intermediate_steps)
+
+    def _flush_intermediate_buffer(self):
+        """Writes the buffered intermediates ('on_failure' mode) after a failure."""
+        while True:
+            try:
+                image, subject_filename, step_suffix = self._intermediate_buffer.popleft()
+            except IndexError:
+                return
+            try:
+                self._write_intermediate(image, subject_filename, step_suffix)
+            except Exception as e:
+                self.logger.error(f"Could not save intermediate {step_suffix}: {str(e)}")
+
+    def _write_intermediate(self, image, subject_filename, step_suffix):
+        if self.intermediate_store is not None:
+            def save():
+                with self._stage('write:intermediate', image):
+                    self.intermediate_store.save(image, subject_filename, step_suffix)
+            if self.writer is not None:
+                self.writer.submit(save, path=os.path.join(self.intermediate_store.path(subject_filename), step_suffix))
+            else:
+                save()
+            self.logger.info(f"Saved intermediate: {step_suffix}")
+            return
+
+        out_path = self._intermediate_path(subject_filename, step_suffix)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        out_path = self._write_image(image, out_path, self.intermediate_codec, kind='intermediate')
+        self._written_intermediates.add(out_path)
+        self.logger.info(f"Saved intermediate: {step_suffix}")
+
+    def _intermediate_path(self, subject_filename, step_suffix):
         # Strip extension for folder name
         base_name = subject_filename.replace('.nii.gz', '').replace('.nii', '')
-        
-        # Create subject specific folder
-        subject_dir = os.path.join(self.intermediate_dir, base_name)
-        os.makedirs(subject_dir, exist_ok=True)
-        
-        out_path = os.path.join(subject_dir, f"{base_name}_{step_suffix}.nii.gz")
-        ants.image_write(image, out_path)
-        self.logger.info(f"Saved intermediate: {step_suffix}")
+        # Subject specific folder
+        path = os.path.join(self.intermediate_dir, base_name, f"{base_name}_{step_suffix}.nii.gz")
+        return codec_path(path, self.intermediate_codec)
+
+    def _write_image(self, image, path, codec, kind='output'):
+        """Writes `image` with `codec`, through the background writer when enabled."""
+        path = codec_path(path, codec)
+
+        def write():
+            with self._stage(f'write:{kind}', image):
+                write_image(image, path, codec=codec)
+
+        if self.writer is not None:
+            self.writer.submit(write, path=path)
+        else:
+            write()
+        return path
 
-    def _process_and_save_lr(self, lr_img, hr_final, filename, suffix):
-        """Helper to process and save a specific LR variant."""
+    def _config_files_current(self):
+        """False if a file the config points to (e.g. the Nyúl landmarks) changed since it was loaded."""
+        for key, digest in self.config_file_digests.items():
+            path = get_config_value(self.cfg, key)
+            if not os.path.exists(path) or file_fingerprint(path) != digest:
+                return False
+        return True
+
+    def _configure_logging(self, log_path=None):
+        """
+        Points the log file at `log_path` (None = 'pipeline.log'). PipelinePool
+        calls this when handing a warm instance to a new job.
+        """
+        self.log_path = log_path
+        set_log_file(self.logger, log_path or 'pipeline.log')
+
+    def close(self):
+        """Flushes and stops the background writer (if any) and closes the log file."""
+        try:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+        finally:
+            set_log_file(self.logger, None)
+
+    def _flush_writes(self):
+        """Waits for queued writes; raises WriteError if any failed."""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def _flush_subject_writes(self, filename, lr_paths):
+        """
+        Waits for the subject's queued writes. As in synchronous mode, a failed
+        write of an LR variant (its output or intermediates) only fails that
+        variant: it is logged and removed from `lr_paths`. Any other failed
+        write raises WriteError. Nothing of the subject is left queued on return.
+        """
         try:
-             # N4 Bias Field Correction
-            if self.cfg['preprocessing']['bias_correction']['enabled']:
-                 mask = ants.get_mask(lr_img)
-                 lr_n4 = ants.n4_bias_field_correction(
-                     lr_img,
-                     mask=mask,
-                     shrink_factor=self.cfg['preprocessing']['bias_correction']['shrink_factor'],
-                     convergence={'iters': self.cfg['preprocessing']['bias_correction']['convergence'], 
-                                  'tol': float(self.cfg['preprocessing']['bias_correction']['tolerance'])}
-                 )
-                 self._save_intermediate(lr_n4, filename, f'{suffix}_03_n4')
+            self._flush_writes()
+        except WriteError as e:
+            base_name = filename.replace('.nii.gz', '').replace('.nii', '')
+            failed = {}
+            for path, message in e.failures.items():
+                name = os.path.basename(path or '')
+                if name.startswith(base_name + '_'):
+                    name = name[len(base_name) + 1:]
+                suffix = next((s for s in lr_paths if name.startswith((s + '.', s + '_'))), None)
+                if path is None or suffix is None:
+                    raise
+                failed.setdefault(suffix, []).append(message)
+            for suffix, messages in failed.items():
+                self.logger.error(f"Failed to write LR {suffix} for {filename}: {'; '.join(messages)}")
+                del lr_paths[suffix]
+            # Buffered intermediates of the failed variants ('on_failure' mode) are
+            # queued now; wait for them too so they cannot fail the next subject
+            self._flush_intermediate_buffer()
+            try:
+                self._flush_writes()
+            except WriteError as write_error:
+                self.logger.error(f"Background writes for {filename} failed: {write_error}")
+
+    def _cache_lr_output(self, key, path, transform_entry=None):
+        """
+        Caches an LR output file, plus its moving image and transforms when
+        given (the variant's manifest entry), so a later cache hit can restore
+        the reapply() inputs too. With the background writer, the copy is queued
+        behind the files' own writes and skipped if one of them failed (the path
+        may still hold the output of an earlier run).
+        """
+        values = {'output': [path]}
+        if transform_entry is not None:
+            values['moving'] = [transform_entry['moving']]
+            values['transforms'] = transform_entry['transforms']
+        if self.writer is None:
+            self.stage_cache.save('lr_variant', key, values)
+            return
+
+        def save():
+            if not any(self.writer.has_failed(p) for p in values['output'] + values.get('moving', [])):
+                self.stage_cache.save('lr_variant', key, values)
+
+        self.writer.submit(save)
+
+    def _restore_cached_lr(self, filename, suffix, cached, transform_entries):
+        """
+        Copies a cached LR variant into this run's outputs and, with the
+        transform store, its moving image and transforms with a manifest entry.
+
+        Returns:
+            str or None: Output path, or None if the entry predates cached
+            transforms and the variant must be recomputed for reapply().
+        """
+        if self.transform_store is not None and not cached.get('moving'):
+            return None
+        out_path = self._lr_output_path(filename, suffix)
+        shutil.copyfile(cached['output'][0], out_path)
+        if self.transform_store is not None:
+            transform_entries['lr'][suffix] = {
+                'moving': self.transform_store.copy_moving(filename, suffix, cached['moving'][0]),
+                'transforms': self.transform_store.save_transforms(filename, f'{suffix}_fwd', cached['transforms']),
+                'output': os.path.abspath(out_path),
+            }
+        return out_path
+
+    def _persist_moving(self, filename, name, moving, step_suffix):
+        """
+        Path of the image a stored transform applies to, for reapply(). The
+        intermediate `step_suffix` is referenced only if this run wrote (or
+        queued) it as a file; a file left over from an earlier run may come from
+        a different config, e.g. when the stage was a cache hit. Otherwise the
+        image is written into the transform store. `moving` may be a callable,
+        so a cached image is only loaded when it must be written.
+        """
+        moving_path = self._intermediate_path(filename, step_suffix)
+        if moving_path in self._written_intermediates:
+            return os.path.abspath(moving_path)
+        if callable(moving):
+            moving = moving()
+        return self.transform_store.save_moving(filename, name, moving)
+
+    def _write_transform_manifest(self, filename, entries, lr_paths):
+        """Merges this run's entries (including variants restored from the stage cache) into the subject manifest."""
+        manifest = self.transform_store.load_manifest(filename) or {}
+        lr_entries = manifest.get('lr', {})
+        lr_entries.update(entries.get('lr', {}))
+        manifest.update({
+            'subject': filename,
+            'hr': entries['hr'],
+            'lr': {suffix: lr_entries[suffix] for suffix in lr_paths if suffix in lr_entries},
+        })
+        self.transform_store.write_manifest(filename, manifest)
+
+    def _bias_correct(self, image, return_bias_field=False):
+        """Runs N4 on `image` with the configured settings (optionally returning the field)."""
+        bc_cfg = self.cfg['preprocessing']['bias_correction']
+        mask = ants.get_mask(image)
+        return ants.n4_bias_field_correction(
+            image,
+            mask=mask,
+            shrink_factor=bc_cfg['shrink_factor'],
+            convergence={'iters': bc_cfg['convergence'], 'tol': float(bc_cfg['tolerance'])},
+            return_bias_field=return_bias_field
+        )
+
+    @staticmethod
+    def _apply_bias_field(image, bias_field):
+        """
+        Divides `image` by a bias field estimated on another grid of the same
+        physical space. The field is smooth, so linear resampling onto the
+        image's grid is sufficient.
+        """
+        field_resampled = ants.resample_image_to_target(bias_field, image, interp_type='linear')
+        field_np = field_resampled.numpy()
+        # Guard against voxels the resampler left outside the field's extent
+        field_np = np.where(field_np > 0, field_np, 1.0)
+        return numpy_to_ants(image.numpy() / field_np, image)
+
+    def _lr_output_path(self, filename, suffix):
+        # Construct filename: subject_suffix.nii.gz (.nii with the 'nii' codec)
+        base_name = filename.replace('.nii.gz', '').replace('.nii', '')
+        return codec_path(os.path.join(self.lr_dir, f"{base_name}_{suffix}.nii.gz"), self.output_codec)
+
+    def _process_and_save_lr(self, lr_img, hr_ref, filename, suffix):
+        """
+        Helper to process and save a specific LR variant.
+
+        Every LR variant is simulated from the same reoriented image as the HR
+        path, so it shares its physical space. This lets the HR bias field and
+        HR->MNI transforms in `hr_ref` be applied to it directly.
+
+        Args:
+            lr_img (ants.ANTsImage): Simulated LR image.
+            hr_ref (_HRReference): HR-path outputs for this subject.
+            filename (str): Subject filename.
+            suffix (str): Variant suffix (e.g. 'thick_3mm').
+        """
+        try:
+            # N4 Bias Field Correction
+            bc_cfg = self.cfg['preprocessing']['bias_correction']
+            bc_mode = bc_cfg.get('lr_mode', 'per_variant')
+            if not bc_cfg['enabled'] or bc_mode == 'degrade_corrected':
+                # Disabled, or the variant was simulated from the N4-corrected HR image
+                lr_n4 = lr_img
+            elif bc_mode == 'reuse_hr_field' and hr_ref.bias_field is not None:
+                lr_n4 = self._apply_bias_field(lr_img, hr_ref.bias_field)
+                self._save_intermediate(lr_n4, filename, f'{suffix}_03_n4')
+            elif bc_mode in ('per_variant', 'reuse_hr_field'):
+                lr_n4 = self._bias_correct(lr_img)
+                self._save_intermediate(lr_n4, filename, f'{suffix}_03_n4')
             else:
-                 lr_n4 = lr_img
+                raise ValueError(f"Unknown bias_correction lr_mode: {bc_mode}")
 
             # Intensity Normalization
-            lr_norm = self.normalizer.apply(lr_n4)
+            norm_mode = self.cfg['preprocessing']['normalization'].get('lr_mode', 'per_variant')
+            if norm_mode == 'reuse_hr' and hr_ref.norm_params is not None:
+                # Same intensity map as the HR image instead of a per-variant WhiteStripe fit
+                lr_norm = self.normalizer.apply(lr_n4, params=hr_ref.norm_params)
+            elif norm_mode in ('per_variant', 'reuse_hr'):
+                lr_norm = self.normalizer.apply(lr_n4)
+            else:
+                raise ValueError(f"Unknown normalization lr_mode: {norm_mode}")
             self._save_intermediate(lr_norm, filename, f'{suffix}_04_norm')
 
             # Registration (LR -> HR-MNI)
-            reg_type = self.cfg['preprocessing']['registration']['type']
-            lr_reg_result = ants.registration(
-                fixed=hr_final,
-                moving=lr_norm,
-                type_of_transform=reg_type
-            )
+            lr_mode = self.cfg['preprocessing']['registration'].get('lr_mode', 'register')
+            if lr_mode == 'reuse_hr' and hr_ref.transforms:
+                # Resample directly into template space with the HR transform
+                transformlist = hr_ref.transforms
+            elif lr_mode in ('reuse_hr', 'register'):
+                reg_type = self.cfg['preprocessing']['registration']['type']
+                lr_reg_result = ants.registration(
+                    fixed=self._registration_target(hr_ref.hr_final),
+                    moving=lr_norm,
+                    type_of_transform=reg_type,
+                    mask=self.template_mask,
+                    **self.registration_kwargs(for_lr=True)
+                )
+                transformlist = lr_reg_result['fwdtransforms']
+            else:
+                raise ValueError(f"Unknown registration lr_mode: {lr_mode}")
             pad_val = lr_norm.min()
             lr_final = ants.apply_transforms(
-                fixed=hr_final,
+                fixed=hr_ref.hr_final,
                 moving=lr_norm,
-                transformlist=lr_reg_result['fwdtransforms'],
+                transformlist=transformlist,
                 interpolator=self.cfg['preprocessing']['registration']['interpolator'],
                 defaultvalue=pad_val
             )
             self._save_intermediate(lr_final, filename, f'{suffix}_05_reg')
 
             # Save Final
-            # Construct filename: subject_suffix.nii.gz
-            base_name = filename.replace('.nii.gz', '').replace('.nii', '')
-            out_name = f"{base_name}_{suffix}.nii.gz"
-            out_path = os.path.join(self.lr_dir, out_name)
-            ants.image_write(lr_final, out_path)
+            out_path = self._lr_output_path(filename, suffix)
+            self._write_image(lr_final, out_path, self.output_codec)
+
+            if self.transform_store is not None:
+                hr_entry = hr_ref.transform_entries.get('hr')
+                if transformlist is hr_ref.transforms and hr_entry is not None:
+                    # Reused HR->MNI transform: point at the stored HR copy
+                    saved = hr_entry['transforms']
+                else:
+                    saved = self.transform_store.save_transforms(filename, f'{suffix}_fwd', transformlist)
+                hr_ref.transform_entries.setdefault('lr', {})[suffix] = {
+                    'moving': self._persist_moving(filename, suffix, lr_norm, f'{suffix}_04_norm'),
+                    'transforms': saved,
+                    'output': os.path.abspath(out_path),
+                }
             return out_path
 
         except Exception as e:
             self.logger.error(f"Failed to process LR {suffix} for {filename}: {str(e)}")
+            self._flush_intermediate_buffer()
             return None
 
-    def process_subject(self, nifti_path: str) -> PipelineResult:
-        filename = os.path.basename(nifti_path)
+    def _fft_workers(self):
+        """
+        scipy.fft thread count for k-space truncation. -1 means all cores, but
+        inside a run_batch worker it is capped at that worker's ITK thread share.
+        """
+        workers = self.cfg['simulation'].get('fft_workers')
+        if workers is not None and int(workers) < 0 and 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS' in os.environ:
+            return int(os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'])
+        return workers
+
+    def _simulate_lr_variants(self, degrader, specs):
+        """
+        Generates the given LR variants lazily, so only the ones in flight are
+        held in memory. Thick-slice and gap variants share the simulator's
+        slice-axis prefix sum, so the volume is traversed only once for them.
+
+        Yields:
+            tuple: (suffix, ANTsImage) pairs in the order of `specs`.
+        """
+        for suffix, kind, params in specs:
+            if kind == 'thick_slices':
+                self.logger.info(f"-> Simulating Thick Slice: {params['thickness_mm']}mm")
+            elif kind == 'inter_slice_gap':
+                self.logger.info(
+                    f"-> Simulating Gap: Thickness={params['thickness_mm']}mm Gap={params['gap_mm']}mm"
+                )
+            elif kind == 'in_plane_resolution':
+                self.logger.info(f"-> Simulating In-Plane Downsample: x{params['downsample_factor']}")
+            with self._stage(f'simulate:{suffix}', degrader.image):
+                lr_sim = degrader.simulate(kind, params)
+            yield suffix, lr_sim
+
+    def _process_lr_variants(self, variants, hr_ref, filename) -> Dict[str, str]:
+        """
+        Runs N4 / normalization / registration for each LR variant, optionally
+        in a bounded thread pool (ANTs releases the GIL inside ITK filters).
+        Each variant fails in isolation; the returned dict keeps config order.
+        """
+        lr_workers = int(self.cfg.get('pipeline_options', {}).get('lr_workers', 1))
         lr_paths: Dict[str, str] = {}
-        self.logger.info(f"Starting subject: {filename}")
 
+        def process(lr_sim, suffix):
+            with self._stage(f'lr:{suffix}', lr_sim) as record:
+                path = self._process_and_save_lr(lr_sim, hr_ref, filename, suffix)
+                record['ok'] = path is not None
+            return path
+
+        if lr_workers <= 1:
+            for suffix, lr_sim in variants:
+                path = process(lr_sim, suffix)
+                if path:
+                    lr_paths[suffix] = path
+            return lr_paths
+
+        self.logger.info(f"Processing LR variants with {lr_workers} threads...")
+        with ThreadPoolExecutor(max_workers=lr_workers) as executor:
+            # Variants are simulated in this thread while earlier ones are processed.
+            # At most lr_workers are outstanding, so the generator is only advanced
+            # (and another variant held in memory) once any of them finishes.
+            in_flight = {}
+            order = []
+            done_paths = {}
+
+            def collect(return_when):
+                done, _ = wait(in_flight, return_when=return_when)
+                for future in done:
+                    done_paths[in_flight.pop(future)] = future.result()
+
+            for suffix, lr_sim in variants:
+                order.append(suffix)
+                in_flight[executor.submit(process, lr_sim, suffix)] = suffix
+                del lr_sim  # Not kept alive by this thread while the next one is simulated
+                if len(in_flight) >= lr_workers:
+                    collect(FIRST_COMPLETED)
+            if in_flight:
+                collect(ALL_COMPLETED)
+        # Same ordering as the serial loop
+        for suffix in order:
+            if done_paths.get(suffix):
+                lr_paths[suffix] = done_paths[suffix]
+        return lr_paths
+
+    def process_subject(self, nifti_path: str, extracted=None) -> PipelineResult:
+        """
+        Runs the full HR + LR pipeline for one subject.
+
+        Args:
+            nifti_path (str): Input NIfTI file.
+            extracted (tuple, optional): Precomputed (brain_image, mask_image) from
+                HD-BET, e.g. prefetched by run_batch (see _prefetch_brain_extraction).
+
+        Stages are evaluated lazily through SubjectStages (see STAGE_GRAPH in
+        stage_cache.py). With pipeline_options.stage_cache enabled, each stage
+        output is stored under a key derived from the input scan and the config
+        values it depends on, so a rerun only computes the invalidated stages.
+        """
+        filename = os.path.basename(nifti_path)
+        self._current_subject = filename
         try:
-            # 1. Load Image
-            raw_img = ants.image_read(nifti_path)
-            
-            # 2. Brain Extraction (if enabled)
-            if self.brain_extractor is not None:
-                self.logger.info("Extracting brain using HD-BET...")
-                raw_img = self.brain_extractor.extract_brain(raw_img)
-                self._save_intermediate(raw_img, filename, '00_brain_extracted')
-            
+            with self._stage('subject') as record:
+                result = self._process_subject(nifti_path, filename, extracted)
+                record['ok'] = result.success
+        finally:
+            self._current_subject = None
+            if self.metrics is not None:
+                self.metrics.write_prometheus()
+            if self.profiler is not None:
+                self.profiler.finish_subject(filename)
+        return result
+
+    def _input_stages(self, nifti_path, filename, stages, extracted=None):
+        """
+        Compute functions of the stages before intensity normalization (brain
+        extraction, crop, reorient, N4) for one subject. Upstream stages are
+        pulled through `stages`, so cached ones are not recomputed.
+
+        Returns:
+            dict: stage name -> compute function for SubjectStages.run().
+        """
+        bc_cfg = self.cfg['preprocessing']['bias_correction']
+
+        def brain_extraction():
+            with self._stage('brain_extraction') as record:
+                if extracted is not None:
+                    # 1-2. Already loaded and skull-stripped by the HD-BET prefetch thread
+                    img, mask = extracted
+                    record['voxels'] = int(np.prod(img.shape))
+                    self._save_intermediate(img, filename, '00_brain_extracted')
+                    return {'image': img, 'mask': mask}
+
+                # 1. Load Image
+                img = ants.image_read(nifti_path)
+                record['voxels'] = int(np.prod(img.shape))
+                mask = None
+
+                # 2. Brain Extraction (if enabled)
+                if self.brain_extractor is not None:
+                    self.logger.info("Extracting brain using HD-BET...")
+                    img, mask = self.brain_extractor.extract_brain(img, return_mask=True)
+                    self._save_intermediate(img, filename, '00_brain_extracted')
+                return {'image': img, 'mask': mask}
+
+        def crop():
+            extraction = stages.run('brain_extraction', brain_extraction)
+            with self._stage('crop', extraction['image']):
+                img = extraction['image']
+                crop_cfg = self.cfg['preprocessing'].get('cropping', {})
+                if crop_cfg.get('enabled', False) and extraction['mask'] is not None:
+                    # Crop to the brain bounding box so later stages skip the empty
+                    # background; the final resample into MNI restores the full grid.
+                    n_before = int(np.prod(img.shape))
+                    img = crop_to_mask(img, extraction['mask'], margin_mm=crop_cfg.get('margin_mm', 10))
+                    self.logger.info(
+                        f"Cropped to brain bounding box: {n_before} -> {int(np.prod(img.shape))} voxels"
+                    )
+                    self._save_intermediate(img, filename, '00_brain_cropped')
+                return {'image': img}
+
+        def reorient():
             # 3. Reorient to Standard System (RAS/LPI)
-            raw_img = ants.reorient_image2(raw_img, orientation='RAI') # Remove this
-            self._save_intermediate(raw_img, filename, '01_raw_reoriented')
+            img = stages.run('crop', crop)['image']
+            with self._stage('reorient', img):
+                img = ants.reorient_image2(img, orientation='RAI') # Remove this
+                self._save_intermediate(img, filename, '01_raw_reoriented')
+                return {'image': img}
+
+        def n4():
+            raw_img = stages.run('reorient', reorient)['image']
+            with self._stage('n4', raw_img):
+                # N4 Bias Field Correction (HR)
+                bias_field = None
+                if bc_cfg['enabled']:
+                    self.logger.info("Applying N4 Bias Correction to HR...")
+                    if bc_cfg.get('lr_mode', 'per_variant') == 'reuse_hr_field':
+                        # Keep the field so LR variants can reuse it instead of refitting N4
+                        bias_field = self._bias_correct(raw_img, return_bias_field=True)
+                        hr_n4 = self._apply_bias_field(raw_img, bias_field)
+                    else:
+                        hr_n4 = self._bias_correct(raw_img)
+                    self._save_intermediate(hr_n4, filename, '03_hr_n4')
+                else:
+                    hr_n4 = raw_img
+                return {'image': hr_n4, 'bias_field': bias_field}
+
+        return {'brain_extraction': brain_extraction, 'crop': crop, 'reorient': reorient, 'n4': n4}
+
+    def normalization_input(self, nifti_path: str) -> ants.ANTsImage:
+        """
+        The image intensity normalization sees for one subject: the output of
+        brain extraction, cropping, reorientation and N4, read from (or added
+        to) the stage cache when enabled. `main.py --fit-nyul` fits the Nyúl
+        landmarks on these images, i.e. on the distribution they are applied to.
+        """
+        filename = os.path.basename(nifti_path)
+        keys = {}
+        if self.stage_cache is not None:
+            keys = self.stage_graph.subject_keys(file_fingerprint(nifti_path))
+        stages = SubjectStages(self.stage_cache, keys, log=self.logger, writer=self.writer)
+        return stages.run('n4', self._input_stages(nifti_path, filename, stages)['n4'])['image']
+
+    def _process_subject(self, nifti_path, filename, extracted):
+        self.logger.info(f"Starting subject: {filename}")
+        self._intermediate_buffer.clear()
+        self._written_intermediates.clear()
+
+        try:
+            bc_cfg = self.cfg['preprocessing']['bias_correction']
+            reg_cfg = self.cfg['preprocessing']['registration']
+            keys = {}
+            if self.stage_cache is not None:
+                keys = self.stage_graph.subject_keys(file_fingerprint(nifti_path))
+            stages = SubjectStages(self.stage_cache, keys, log=self.logger, writer=self.writer)
+
+            compute = self._input_stages(nifti_path, filename, stages, extracted)
+            reorient = compute['reorient']
+            n4 = compute['n4']
 
             # ---------------- HR PIPELINE ----------------
+            def normalize():
+                hr_n4 = stages.run('n4', n4)['image']
+                with self._stage('normalize', hr_n4):
+                    # Intensity Normalization (HR)
+                    self.logger.info(f"Applying {self.normalizer.method} Normalization to HR...")
+                    norm_params = self.normalizer.fit(hr_n4)
+                    hr_norm = self.normalizer.apply(hr_n4, params=norm_params)
+                    self._save_intermediate(hr_norm, filename, '04_hr_norm')
+                    return {'image': hr_norm, 'params': norm_params}
+
+            def register():
+                normalized = stages.run('normalize', normalize)
+                hr_norm = normalized['image']
+                with self._stage('register', hr_norm):
+                    # Registration HR -> MNI
+                    reg_type = reg_cfg['type']
+                    self.logger.info(f"Registering HR to MNI152 ({reg_type}, preset: {reg_cfg.get('preset') or 'default'})...")
+                    hr_reg_result = ants.registration(
+                        fixed=self.registration_template,
+                        moving=hr_norm, 
+                        type_of_transform=reg_type,
+                        mask=self.template_mask,
+                        **self.registration_kwargs()
+                    )
+                    hr_final = ants.apply_transforms(
+                        fixed=self.mni_template,
+                        moving=hr_norm,
+                        transformlist=hr_reg_result['fwdtransforms'],
+                        interpolator=reg_cfg['interpolator'],
+                        defaultvalue=hr_norm.min()
+                    )
+                    self._save_intermediate(hr_final, filename, '05_hr_registered_mni')
+                    return {
+                        'image': hr_final,
+                        'transforms': hr_reg_result['fwdtransforms'],
+                        # Carried along so a cached registration needs no normalize reload
+                        'norm_params': normalized['params'],
+                    }
+
             self.logger.info("Processing HR path...")
-            
-            # N4 Bias Field Correction (HR)
-            if self.cfg['preprocessing']['bias_correction']['enabled']:
-                self.logger.info("Applying N4 Bias Correction to HR...")
-                mask = ants.get_mask(raw_img)
-                hr_n4 = ants.n4_bias_field_correction(
-                    raw_img, 
-                    mask=mask,
-                    shrink_factor=self.cfg['preprocessing']['bias_correction']['shrink_factor'],
-                    convergence={'iters': self.cfg['preprocessing']['bias_correction']['convergence'], 
-                                 'tol': float(self.cfg['preprocessing']['bias_correction']['tolerance'])}
-                )
-                self._save_intermediate(hr_n4, filename, '03_hr_n4')
-            else:
-                hr_n4 = raw_img
-            
-            # Intensity Normalization (HR)
-            self.logger.info(f"Applying {self.normalizer.method} Normalization to HR...")
-            hr_norm = self.normalizer.apply(hr_n4)
-            self._save_intermediate(hr_norm, filename, '04_hr_norm')
-            
-            # Registration HR -> MNI
-            reg_type = self.cfg['preprocessing']['registration']['type']
-            self.logger.info(f"Registering HR to MNI152 ({reg_type})...")
-            hr_reg_result = ants.registration(
-                fixed=self.mni_template, 
-                moving=hr_norm, 
-                type_of_transform=reg_type
-            )
-            hr_final = ants.apply_transforms(
-                fixed=self.mni_template,
-                moving=hr_norm,
-                transformlist=hr_reg_result['fwdtransforms'],
-                interpolator=self.cfg['preprocessing']['registration']['interpolator'],
-                defaultvalue=hr_norm.min()
-            )
-            self._save_intermediate(hr_final, filename, '05_hr_registered_mni')
-            
+            hr_registered = stages.run('register', register)
+            hr_final = hr_registered['image']
+
             # Save HR Final
-            hr_out = os.path.join(self.hr_dir, filename)
-            ants.image_write(hr_final, hr_out)
+            hr_out = codec_path(os.path.join(self.hr_dir, filename), self.output_codec)
+            self._write_image(hr_final, hr_out, self.output_codec)
+
+            transform_entries = {'lr': {}}
+            if self.transform_store is not None:
+                transform_entries['hr'] = {
+                    'moving': self._persist_moving(
+                        filename, 'hr', lambda: stages.run('normalize', normalize)['image'], '04_hr_norm'
+                    ),
+                    'transforms': self.transform_store.save_transforms(
+                        filename, 'hr_fwd', hr_registered['transforms']
+                    ),
+                    'output': os.path.abspath(hr_out),
+                }
 
             # ---------------- LR SIMULATION LOOP ----------------
-            self.logger.info("Simulating LR variants...")
-            # Instantiate simulator with the reoriented raw image
-            degrader = DegradationSimulator(raw_img)
-            sim_cfg = self.cfg['simulation']
-
-            # 1. Thick Slices
-            if 'thick_slices' in sim_cfg and sim_cfg['thick_slices']:
-                for thickness in sim_cfg['thick_slices']:
-                    suffix = f"thick_{int(thickness)}mm"
-                    self.logger.info(f"-> Simulating Thick Slice: {thickness}mm")
-                    lr_sim = degrader.simulate_thick_slices(thickness_mm=float(thickness))
-                    path = self._process_and_save_lr(lr_sim, hr_final, filename, suffix)
-                    if path:
-                        lr_paths[suffix] = path
-
-            # 2. Inter-slice Gaps
-            if 'inter_slice_gap' in sim_cfg and sim_cfg['inter_slice_gap']:
-                for gap_cfg in sim_cfg['inter_slice_gap']:
-                    th = float(gap_cfg['thickness'])
-                    gp = float(gap_cfg['gap'])
-                    suffix = f"gap_th{int(th)}_gap{int(gp)}mm"
-                    self.logger.info(f"-> Simulating Gap: Thickness={th}mm Gap={gp}mm")
-                    lr_sim = degrader.simulate_inter_slice_gap(thickness_mm=th, gap_mm=gp)
-                    path = self._process_and_save_lr(lr_sim, hr_final, filename, suffix)
-                    if path:
-                        lr_paths[suffix] = path
-
-            # 3. In-plane Resolution
-            if 'in_plane_resolution' in sim_cfg and sim_cfg['in_plane_resolution']:
-                for factor in sim_cfg['in_plane_resolution']:
-                    suffix = f"inplane_ds{factor}"
-                    self.logger.info(f"-> Simulating In-Plane Downsample: x{factor}")
-                    lr_sim = degrader.simulate_in_plane_resolution(downsample_factor=int(factor))
-                    path = self._process_and_save_lr(lr_sim, hr_final, filename, suffix)
-                    if path:
-                        lr_paths[suffix] = path
+            specs = lr_variant_specs(self.cfg['simulation'])
+            lr_paths: Dict[str, str] = {}
+            variant_keys = {}
+            if self.stage_cache is not None:
+                # Restore variants whose inputs and settings are unchanged
+                for suffix, kind, params in specs:
+                    variant_keys[suffix] = self.stage_graph.key(
+                        'lr_variant', keys, extra={'kind': kind, 'params': params}
+                    )
+                    cached = self.stage_cache.load('lr_variant', variant_keys[suffix])
+                    if cached is not None:
+                        out_path = self._restore_cached_lr(filename, suffix, cached, transform_entries)
+                        if out_path is not None:
+                            self.logger.info(f"Stage cache hit: LR {suffix}")
+                            lr_paths[suffix] = out_path
+            missing = [spec for spec in specs if spec[0] not in lr_paths]
+
+            if missing:
+                self.logger.info("Simulating LR variants...")
+                # Instantiate simulator with the reoriented raw image, or with the
+                # N4-corrected image when LR variants should inherit the HR correction
+                hr_corrected = stages.run('n4', n4)
+                if bc_cfg['enabled'] and bc_cfg.get('lr_mode', 'per_variant') == 'degrade_corrected':
+                    degrader_input = hr_corrected['image']
+                else:
+                    degrader_input = stages.run('reorient', reorient)['image']
+                degrader = DegradationSimulator(degrader_input, fft_workers=self._fft_workers())
+                hr_ref = _HRReference(
+                    hr_final=hr_final,
+                    transforms=hr_registered['transforms'],
+                    bias_field=hr_corrected['bias_field'],
+                    norm_params=hr_registered.get('norm_params'),
+                    transform_entries=transform_entries,
+                )
+                lr_variants = self._simulate_lr_variants(degrader, missing)
+                new_paths = self._process_lr_variants(lr_variants, hr_ref, filename)
+                if self.stage_cache is not None:
+                    for suffix, path in new_paths.items():
+                        self._cache_lr_output(variant_keys[suffix], path, transform_entries['lr'].get(suffix))
+                lr_paths.update(new_paths)
 
+            # Keep config order regardless of which variants came from the cache
+            lr_paths = {suffix: lr_paths[suffix] for suffix, _, _ in specs if suffix in lr_paths}
+
+            # Outputs are only reported once every queued write has landed
+            self._flush_subject_writes(filename, lr_paths)
+            if self.transform_store is not None:
+                self._write_transform_manifest(filename, transform_entries, lr_paths)
+            self._intermediate_buffer.clear()
             self.logger.info(f"Successfully processed {filename}")
             return PipelineResult(
                 subject_filename=filename,
                 hr_path=hr_out,
                 lr_paths=lr_paths,
+                normalization_params=hr_registered.get('norm_params'),
             )
 
         except Exception as e:
             self.logger.error(f"Failed to process {filename}: {str(e)}")
+            self._flush_intermediate_buffer()
+            try:
+                # Let queued intermediates finish (useful for debugging the failure)
+                self._flush_writes()
+            except WriteError as write_error:
+                self.logger.error(f"Background writes for {filename} failed: {write_error}")
             return PipelineResult(
                 subject_filename=filename,
                 hr_path="",
                 error=str(e),
             )
 
-    def run_batch(self):
+    def _needs_brain_extraction(self, input_fingerprint):
+        """
+        Whether process_subject would run HD-BET for a subject. False when the
+        stage cache holds the extraction itself, or every stage process_subject
+        pulls from below it (registration, the LR variants and, for the transform
+        store, the normalized image).
+        """
+        if self.stage_cache is None:
+            return True
+        keys = self.stage_graph.subject_keys(input_fingerprint)
+        wanted = ['register']
+        if self.transform_store is not None:
+            wanted.append('normalize')
+        for suffix, kind, params in lr_variant_specs(self.cfg['simulation']):
+            key = self.stage_graph.key('lr_variant', keys, extra={'kind': kind, 'params': params})
+            if not self.stage_cache.contains('lr_variant', key):
+                # A missing variant is simulated from the reoriented/N4 image
+                wanted += ['n4', 'reorient']
+                break
+        while wanted:
+            stage = wanted.pop()
+            if self.stage_cache.contains(stage, keys[stage]):
+                continue
+            if stage == 'brain_extraction':
+                return True
+            wanted.extend(self.stage_graph.graph[stage][0])
+        return False
+
+    def _prefetch_brain_extraction(self, paths, extract=None):
+        """
+        Prefetches HD-BET results in a background thread, so inference of the next
+        subject overlaps N4/registration of the current one. Subjects still go
+        through the predictor one at a time (no batched inference); the thread
+        runs at most `brain_extraction.batch_prefetch` subjects ahead.
+
+        Args:
+            paths (list): Subjects in processing order.
+            extract (set, optional): Subset of `paths` to prefetch (default: all).
+                The others are yielded without a result, e.g. subjects whose
+                downstream stages are all in the stage cache.
+
+        Yields:
+            tuple: (path, (brain_image, mask_image)) in the order of `paths`, or
+            (path, None) if the subject was not prefetched or extraction failed;
+            process_subject then extracts it itself if needed.
+        """
+        extract = set(paths) if extract is None else set(extract)
+        prefetch = int(self.cfg['preprocessing']['brain_extraction'].get('batch_prefetch', 1))
+        results = queue.Queue(maxsize=max(1, prefetch))
+        done = object()
+
+        def producer():
+            try:
+                stream = self.brain_extractor.iter_extract_brain((p, p) for p in paths if p in extract)
+                for path, brain, mask, error in stream:
+                    results.put((path, (brain, mask) if error is None else None))
+            finally:
+                results.put(done)
+
+        worker = threading.Thread(target=producer, name='hdbet-prefetch', daemon=True)
+        worker.start()
+        finished = False
+        for path in paths:
+            if path not in extract or finished:
+                yield path, None
+                continue
+            item = results.get()
+            if item is done:
+                # The producer stopped early; remaining subjects extract themselves
+                finished = True
+                yield path, None
+                continue
+            yield item
+        worker.join()
+
+    def run_batch(self, workers: int = None, resume: bool = None) -> BatchSummary:
+        """
+        Process every NIfTI file in input_dir.
+
+        Args:
+            workers (int, optional): Number of worker processes. Defaults to
+                pipeline_options.workers from the config (1 = serial, in-process).
+            resume (bool, optional): Skip subjects the batch journal records as
+                completed with the same input and config. Defaults to
+                pipeline_options.resume (True).
+
+        Returns:
+            BatchSummary with one PipelineResult per processed subject.
+        """
         input_dir = self.cfg['paths']['input_dir']
-        files = [f for f in os.listdir(input_dir) if f.endswith(('.nii.gz', '.nii'))]
+        files = sorted(f for f in os.listdir(input_dir) if f.endswith(('.nii.gz', '.nii')))
+        paths = [os.path.join(input_dir, f) for f in files]
+
+        options = self.cfg.get('pipeline_options', {})
+        if workers is None:
+            workers = options.get('workers', 1)
+        if resume is None:
+            resume = options.get('resume', True)
 
         self.logger.info(f"Found {len(files)} files to process.")
-        for f in files:
-            self.process_subject(os.path.join(input_dir, f))
+        summary = BatchSummary()
+        if self.metrics is not None:
+            summary.run_id = self.metrics.new_run()
+        start = time.time()
+
+        journal = BatchJournal(os.path.join(self.cfg['paths']['output_dir'], 'batch_journal.jsonl'))
+        config_hash = hash_config(self.cfg, OUTPUT_CONFIG_KEYS, self.config_file_digests)
+        fingerprints = {}
+        pending = []
+        for path in paths:
+            filename = os.path.basename(path)
+            fingerprints[filename] = file_fingerprint(path)
+            if resume and journal.is_complete(filename, fingerprints[filename], config_hash):
+                summary.skipped.append(filename)
+            else:
+                pending.append(path)
+        if summary.skipped:
+            self.logger.info(f"Skipping {len(summary.skipped)} subjects already completed (batch journal).")
+
+        def _record(result):
+            journal.record(result, fingerprints[result.subject_filename], config_hash)
+            summary.results.append(result)
+
+        workers = max(1, min(int(workers), len(pending) or 1))
+        summary.workers = workers
 
+        batch_extraction = (
+            self.brain_extractor is not None
+            and self.cfg['preprocessing']['brain_extraction'].get('batch', False)
+        )
+
+        if workers == 1 and batch_extraction:
+            extract = [p for p in pending if self._needs_brain_extraction(fingerprints[os.path.basename(p)])]
+            self.logger.info(
+                f"Prefetching HD-BET for {len(extract)} of {len(pending)} subjects in a background thread..."
+            )
+            for path, extracted in self._prefetch_brain_extraction(pending, extract):
+                _record(self.process_subject(path, extracted=extracted))
+        elif workers == 1:
+            for path in pending:
+                _record(self.process_subject(path))
+        else:
+            itk_threads = max(1, (os.cpu_count() or 1) // workers)
+            self.logger.info(
+                f"Running batch with {workers} worker processes ({itk_threads} threads each)."
+            )
+            # 'spawn' avoids forking a parent that already holds ITK/torch thread pools.
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=ctx,
+                initializer=_init_batch_worker,
+                initargs=(self.config_path, self.cfg['paths']['output_dir'], self.log_path, itk_threads,
+                          summary.run_id),
+            ) as executor:
+                futures = {executor.submit(_process_in_worker, p): p for p in pending}
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # Worker crashed outright (e.g. killed by the OOM killer)
+                        self.logger.error(f"Worker failed on {os.path.basename(path)}: {str(e)}")
+                        result = PipelineResult(
+                            subject_filename=os.path.basename(path),
+                            hr_path="",
+                            error=str(e),
+                        )
+                    _record(result)
+
+        summary.elapsed_s = time.time() - start
+        self.logger.info(
+            f"Batch complete: {len(summary.succeeded)} succeeded, {len(summary.failed)} failed, "
+            f"{len(summary.skipped)} skipped in {summary.elapsed_s / 60:.1f} min."
+        )
+        for r in summary.failed:
+            self.logger.info(f"  FAILED {r.subject_filename}: {r.error}")
+        return summary
+
+    def reapply(self, filenames: List[str] = None) -> List[PipelineResult]:
+        """
+        Regenerates final HR/LR images from stored transforms and moving images
+        with ants.apply_transforms only (no N4, normalization or registration),
+        e.g. after changing registration.interpolator or the template grid.
+
+        Args:
+            filenames (list, optional): Subject filenames; defaults to every
+                subject in <output_dir>/transforms.
+
+        Returns:
+            list: One PipelineResult per subject.
+        """
+        if self.transform_store is None:
+            raise RuntimeError("reapply() needs pipeline_options.save_transforms")
+        interpolator = self.cfg['preprocessing']['registration']['interpolator']
+
+        def _apply(entry, out_path):
+            moving = ants.image_read(entry['moving'])
+            warped = ants.apply_transforms(
+                fixed=self.mni_template,
+                moving=moving,
+                transformlist=entry['transforms'],
+                interpolator=interpolator,
+                defaultvalue=moving.min()
+            )
+            return self._write_image(warped, out_path, self.output_codec)
+
+        if filenames is None:
+            manifests = list(self.transform_store.manifests())
+        else:
+            manifests = [self.transform_store.load_manifest(f) or {'subject': f} for f in filenames]
+
+        results = []
+        for manifest in manifests:
+            filename = manifest['subject']
+            try:
+                if 'hr' not in manifest:
+                    raise FileNotFoundError("no stored transforms")
+                self.logger.info(f"Reapplying transforms for {filename} ({interpolator})...")
+                hr_out = _apply(manifest['hr'], codec_path(os.path.join(self.hr_dir, filename), self.output_codec))
+                lr_paths = {
+                    suffix: _apply(entry, self._lr_output_path(filename, suffix))
+                    for suffix, entry in manifest.get('lr', {}).items()
+                }
+                self._flush_writes()
+                results.append(PipelineResult(subject_filename=filename, hr_path=hr_out, lr_paths=lr_paths))
+            except Exception as e:
+                self.logger.error(f"Failed to reapply transforms for {filename}: {str(e)}")
+                results.append(PipelineResult(subject_filename=filename, hr_path="", error=str(e)))
+        return results
 
 def run_single(
     nifti_path: str,
     output_dir: str,
     config_path: str,
     log_path: str = None,
+    use_pool: bool = True,
 ) -> PipelineResult:
     """
     Public API for backend integration.
     Processes one NIfTI file and returns a structured PipelineResult.
+
+    With `use_pool` the call borrows a warm pipeline (template, HD-BET
+    predictor) for this config from the default PipelinePool instead of
+    building a new one.
     """
+    if use_pool:
+        from .pool import get_default_pool
+        with get_default_pool().pipeline(config_path, output_dir=output_dir, log_path=log_path) as pipeline:
+            return pipeline.process_subject(nifti_path)
     pipeline = MRIPreprocessingPipeline(
         config_path=config_path,
         output_dir=output_dir,
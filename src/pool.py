@@ -0,0 +1,181 @@
+import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from .pipeline import MRIPreprocessingPipeline
+
+
+def _config_digest(config_path):
+    """Content hash of a config file, so edited configs never reuse stale instances."""
+    with open(config_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+class PipelinePool:
+    """
+    Warm MRIPreprocessingPipeline instances shared across run_single calls.
+
+    Building a pipeline loads the MNI template and the HD-BET predictor, which
+    costs far more than many single-subject jobs. The pool keeps released
+    instances keyed by (config path, config content hash) and hands them out
+    again with the caller's output directory and log file. An instance is
+    used by one caller at a time; acquire/release are thread-safe.
+
+    Idle instances are evicted after `max_idle_s` seconds by a background
+    thread (and on every acquire/release or evict_idle()). At most
+    `max_idle_per_key` idle instances are kept per config and `max_idle` in
+    total; beyond that the least recently released are dropped.
+    """
+
+    def __init__(self, max_idle_s=900, max_idle_per_key=2, max_idle=4, factory=MRIPreprocessingPipeline):
+        self.max_idle_s = max_idle_s
+        self.max_idle_per_key = max_idle_per_key
+        self.max_idle = max_idle
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._idle = {}  # key -> [(pipeline, released_at)], most recently released last
+        self._keys = {}  # id(pipeline) -> key, for instances handed out
+        self._reaper = None
+
+    def _key(self, config_path):
+        return (os.path.abspath(config_path), _config_digest(config_path))
+
+    def acquire(self, config_path, output_dir=None, log_path=None):
+        """
+        Returns a pipeline for `config_path` writing to `output_dir`, reusing
+        an idle instance when one exists. Pair with release().
+        """
+        key = self._key(config_path)
+        pipeline = None
+        with self._lock:
+            evicted = self._evict_idle_locked(time.monotonic())
+            idle = self._idle.get(key)
+            if idle:
+                pipeline, _ = idle.pop()
+                if not idle:
+                    del self._idle[key]
+        self._close(p for p, _ in evicted)
+        if pipeline is not None and not pipeline._config_files_current():
+            # e.g. the Nyúl landmarks were refitted since this instance loaded them
+            self._close([pipeline])
+            pipeline = None
+        if pipeline is None:
+            # Built outside the lock: other configs are not blocked by a cold start
+            pipeline = self.factory(config_path=config_path, output_dir=output_dir, log_path=log_path)
+        else:
+            pipeline._configure_outputs(output_dir)
+            pipeline._configure_logging(log_path)
+        with self._lock:
+            self._keys[id(pipeline)] = key
+        return pipeline
+
+    def release(self, pipeline):
+        """Returns an acquired pipeline to the pool."""
+        now = time.monotonic()
+        with self._lock:
+            key = self._keys.pop(id(pipeline), None)
+            if key is None:
+                raise ValueError("Pipeline was not acquired from this pool")
+            idle = self._idle.setdefault(key, [])
+            idle.append((pipeline, now))
+            # Drop the least recently used instances beyond the per-key limit
+            dropped = idle[:max(0, len(idle) - self.max_idle_per_key)]
+            del idle[:len(dropped)]
+            dropped += self._evict_idle_locked(now)
+            dropped += self._trim_idle_locked()
+            self._start_reaper_locked()
+        self._close(p for p, _ in dropped)
+
+    @contextmanager
+    def pipeline(self, config_path, output_dir=None, log_path=None):
+        """Context manager around acquire()/release()."""
+        pipeline = self.acquire(config_path, output_dir=output_dir, log_path=log_path)
+        try:
+            yield pipeline
+        finally:
+            self.release(pipeline)
+
+    def _evict_idle_locked(self, now):
+        """Removes expired idle entries and returns them (closed by the caller, outside the lock)."""
+        evicted = []
+        for key in list(self._idle):
+            kept = []
+            for entry in self._idle[key]:
+                (kept if now - entry[1] <= self.max_idle_s else evicted).append(entry)
+            if kept:
+                self._idle[key] = kept
+            else:
+                del self._idle[key]
+        return evicted
+
+    def _trim_idle_locked(self):
+        """Removes the least recently released entries beyond max_idle and returns them."""
+        entries = sorted(
+            ((released_at, key) for key, idle in self._idle.items() for _, released_at in idle),
+            key=lambda entry: entry[0],
+        )
+        trimmed = []
+        for _, key in entries[:max(0, len(entries) - self.max_idle)]:
+            trimmed.append(self._idle[key].pop(0))
+            if not self._idle[key]:
+                del self._idle[key]
+        return trimmed
+
+    def _start_reaper_locked(self):
+        if self._idle and self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, name='pipeline-pool-reaper', daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        """Evicts expired instances without waiting for the next acquire/release."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self._reaper = None
+                    return
+                oldest = min(released_at for idle in self._idle.values() for _, released_at in idle)
+            time.sleep(max(0.0, oldest + self.max_idle_s - time.monotonic()) + 0.01)
+            self.evict_idle()
+
+    @staticmethod
+    def _close(pipelines):
+        for pipeline in pipelines:
+            close = getattr(pipeline, 'close', None)
+            if close is not None:
+                close()
+
+    def evict_idle(self):
+        """Drops instances idle for longer than max_idle_s. Returns how many were dropped."""
+        with self._lock:
+            evicted = self._evict_idle_locked(time.monotonic())
+        self._close(p for p, _ in evicted)
+        return len(evicted)
+
+    def clear(self):
+        """Drops every idle instance (instances in use are unaffected)."""
+        with self._lock:
+            evicted = [entry for entries in self._idle.values() for entry in entries]
+            self._idle.clear()
+        self._close(p for p, _ in evicted)
+
+    def stats(self):
+        """Idle and in-use instance counts."""
+        with self._lock:
+            return {
+                'idle': sum(len(v) for v in self._idle.values()),
+                'in_use': len(self._keys),
+            }
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """Process-wide pool used by run_single()."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = PipelinePool()
+        return _default_pool
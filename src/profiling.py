@@ -0,0 +1,176 @@
+import os
+import glob
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+
+def stage_file_name(stage):
+    """File-system safe name of a stage ('lr:thick_3mm' -> 'lr.thick_3mm')."""
+    return stage.replace(':', '.').replace(os.sep, '_')
+
+
+class StageProfiler:
+    """
+    Opt-in CPU profiles of selected pipeline stages.
+
+    Stages are selected by full name or by the prefix before ':' (so 'lr'
+    selects every 'lr:<suffix>' variant). All invocations of a stage for one
+    subject accumulate into a single profile, written by finish_subject() to
+    <profile_dir>/<subject>/<stage>.prof (cProfile, readable with pstats) or
+    <stage>.txt/.pyisession (pyinstrument sampling profiler).
+
+    Only one stage is profiled at a time per thread (nested stages run
+    unprofiled inside their parent), and stages that cannot attach because
+    another profiler is active (Python 3.12+ allows one per process) are skipped.
+    """
+
+    def __init__(self, profile_dir, profiler='cprofile', stages=None, interval=0.001):
+        """
+        Args:
+            profile_dir (str): Output directory.
+            profiler (str): 'cprofile' (deterministic) or 'pyinstrument' (sampling).
+            stages (list, optional): Stage names/prefixes to profile; empty = all.
+            interval (float): pyinstrument sampling interval in seconds.
+        """
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profiler}")
+        if profiler == 'pyinstrument':
+            import pyinstrument  # noqa: F401 (fail at setup, not mid-run)
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.stages = set(stages or [])
+        self.interval = interval
+        os.makedirs(profile_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # (subject, stage) -> cProfile.Profile, or list of pyinstrument sessions
+        self._profiles = {}
+
+    def wants(self, stage):
+        return not self.stages or stage in self.stages or stage.split(':', 1)[0] in self.stages
+
+    @contextmanager
+    def profile(self, subject, stage):
+        """Profiles the enclosed block if `stage` is selected."""
+        if subject is None or not self.wants(stage) or getattr(self._local, 'active', False):
+            yield
+            return
+        key = (subject, stage)
+        if self.profiler == 'cprofile':
+            with self._lock:
+                prof = self._profiles.setdefault(key, cProfile.Profile())
+            try:
+                prof.enable()
+            except ValueError as e:
+                # Another profiler is active (e.g. a concurrent stage on Python 3.12+)
+                logger.debug(f"Not profiling {stage} for {subject}: {e}")
+                yield
+                return
+            self._local.active = True
+            try:
+                yield
+            finally:
+                prof.disable()
+                self._local.active = False
+        else:
+            from pyinstrument import Profiler
+            prof = Profiler(interval=self.interval)
+            try:
+                prof.start()
+            except RuntimeError as e:
+                logger.debug(f"Not profiling {stage} for {subject}: {e}")
+                yield
+                return
+            self._local.active = True
+            try:
+                yield
+            finally:
+                session = prof.stop()
+                self._local.active = False
+                with self._lock:
+                    self._profiles.setdefault(key, []).append(session)
+
+    def finish_subject(self, subject):
+        """Writes and drops the accumulated profiles of `subject`. Returns the written paths."""
+        with self._lock:
+            keys = [key for key in self._profiles if key[0] == subject]
+            profiles = {key: self._profiles.pop(key) for key in keys}
+        if not profiles:
+            return []
+        base_name = subject.replace('.nii.gz', '').replace('.nii', '')
+        subject_dir = os.path.join(self.profile_dir, base_name)
+        os.makedirs(subject_dir, exist_ok=True)
+
+        paths = []
+        for (_, stage), prof in profiles.items():
+            stem = os.path.join(subject_dir, stage_file_name(stage))
+            if self.profiler == 'cprofile':
+                prof.dump_stats(stem + '.prof')
+                paths.append(stem + '.prof')
+            else:
+                from pyinstrument.session import Session
+                from pyinstrument.renderers import ConsoleRenderer
+                session = prof[0]
+                for other in prof[1:]:
+                    session = Session.combine(session, other)
+                session.save(stem + '.pyisession')
+                with open(stem + '.txt', 'w') as f:
+                    f.write(ConsoleRenderer(unicode=False, color=False).render(session))
+                paths.append(stem + '.txt')
+        return paths
+
+
+def load_profiles(profile_dir, stages=None):
+    """
+    Merges the cProfile files under `profile_dir` per stage.
+
+    Stage names are grouped by their prefix before ':' (written as '.' in
+    file names, so 'lr.thick_3mm.prof' is grouped under 'lr'), matching
+    summarize_metrics().
+
+    Args:
+        profile_dir (str): Directory written by StageProfiler.
+        stages (list, optional): Only load these stage groups.
+
+    Returns:
+        dict: {stage: (pstats.Stats, number of profile files)}
+    """
+    merged = {}
+    for path in sorted(glob.glob(os.path.join(profile_dir, '*', '*.prof'))):
+        stage = os.path.basename(path).split('.', 1)[0]
+        if stages and stage not in stages:
+            continue
+        if stage in merged:
+            merged[stage][0].add(path)
+            merged[stage][1] += 1
+        else:
+            merged[stage] = [pstats.Stats(path), 1]
+    return {stage: (stats, count) for stage, (stats, count) in merged.items()}
+
+
+def top_functions(stats, n=20, sort='tottime'):
+    """
+    Hottest functions of a pstats.Stats.
+
+    Args:
+        sort (str): 'tottime' (time in the function itself) or 'cumtime'
+            (including callees).
+
+    Returns:
+        list: Dicts with 'function', 'ncalls', 'tottime', 'cumtime', sorted descending.
+    """
+    if sort not in ('tottime', 'cumtime'):
+        raise ValueError(f"Unknown sort key: {sort}")
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        location = name if filename == '~' else f"{os.path.basename(filename)}:{line}({name})"
+        rows.append({'function': location, 'ncalls': ncalls, 'tottime': tottime, 'cumtime': cumtime})
+    rows.sort(key=lambda r: r[sort], reverse=True)
+    return rows[:n]
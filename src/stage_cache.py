@@ -0,0 +1,267 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import ants
+from .utils import get_config_value, select_file_digests
+from .writer import codec_path, write_image
+
+logger = logging.getLogger(__name__)
+
+
+# Stage dependency graph of MRIPreprocessingPipeline.process_subject.
+# stage -> (upstream stages, config keys whose values change the stage output)
+# A stage's cache key hashes its upstream keys and these config values, so
+# editing one config section only invalidates the stages below it.
+STAGE_GRAPH = {
+    'brain_extraction': ((), ('preprocessing.brain_extraction.enabled',
+                              'preprocessing.brain_extraction.disable_tta')),
+    'crop': (('brain_extraction',), ('preprocessing.cropping',)),
+    'reorient': (('crop',), ()),
+    'n4': (('reorient',), ('preprocessing.bias_correction',)),
+    'normalize': (('n4',), ('preprocessing.normalization',)),
+    'register': (('normalize',), ('paths.template_path',
+                                  'paths.template_mask_path',
+                                  'preprocessing.registration.type',
+                                  'preprocessing.registration.interpolator',
+                                  'preprocessing.registration.use_template_mask',
+                                  'preprocessing.registration.preset',
+                                  'preprocessing.registration.presets',
+                                  'preprocessing.registration.template_crop_margin_mm')),
+    # One node per configured degradation; its parameters (including the slice
+    # profile) are passed as `extra`
+    'lr_variant': (('register',), ('preprocessing.bias_correction',
+                                   'preprocessing.normalization',
+                                   'preprocessing.registration',
+                                   'pipeline_options.output_codec')),
+}
+
+
+def _hash_payload(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+
+class StageGraph:
+    """Computes content-addressed keys for the stages in STAGE_GRAPH."""
+
+    def __init__(self, cfg, graph=None, file_digests=None):
+        """
+        Args:
+            cfg (dict): Parsed YAML config.
+            graph (dict, optional): Stage graph (default: STAGE_GRAPH).
+            file_digests (dict, optional): Dotted key of a path-valued setting ->
+                content digest of that file (e.g. the Nyúl landmark index); a stage
+                depending on a config section also depends on the files under it.
+        """
+        self.cfg = cfg
+        self.graph = graph or STAGE_GRAPH
+        self.file_digests = file_digests or {}
+
+    def key(self, stage, upstream_keys, extra=None):
+        """
+        Key of `stage` given the already-computed keys of its upstream stages.
+
+        Args:
+            stage (str): Stage name in the graph.
+            upstream_keys (dict): stage -> key for (at least) the direct dependencies.
+                The subject's input fingerprint is passed as the 'input' entry.
+            extra (dict, optional): Additional parameters (e.g. a degradation spec).
+        """
+        deps, cfg_keys = self.graph[stage]
+        payload = {
+            'stage': stage,
+            'deps': {d: upstream_keys[d] for d in deps} if deps else {'input': upstream_keys['input']},
+            'cfg': {k: get_config_value(self.cfg, k) for k in cfg_keys},
+            'extra': extra,
+        }
+        files = select_file_digests(self.file_digests, cfg_keys)
+        if files:
+            payload['files'] = files
+        return _hash_payload(payload)
+
+    def subject_keys(self, input_fingerprint):
+        """Keys for every fixed (non-variant) stage of one subject, in topological order."""
+        keys = {'input': input_fingerprint}
+        for stage in self.graph:
+            if stage == 'lr_variant':
+                continue
+            keys[stage] = self.key(stage, keys)
+        return keys
+
+
+class StageCache:
+    """
+    On-disk cache of stage outputs: <cache_dir>/<stage>/<key>/.
+
+    An entry holds named values, each either an ANTsImage (stored as NIfTI),
+    a list of file paths (copied in, e.g. registration transforms), a
+    JSON-serializable dict (stored inline, e.g. normalization parameters) or None.
+    meta.json is written last, so half-written entries are never read.
+
+    The least recently used entries are evicted once the cache grows beyond
+    `max_size_gb`. Caching is best-effort: a failed save is logged and an
+    unreadable entry counts as a miss.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=50.0, codec='gzip'):
+        """
+        Args:
+            cache_dir (str): Cache root.
+            max_size_gb (float): Size limit of the cache directory in gigabytes.
+            codec (str): NIfTI codec for cached images (see writer.CODECS).
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(float(max_size_gb) * 1024 ** 3)
+        self.codec = codec
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def contains(self, stage, key):
+        """Whether a complete entry exists for (stage, key), without loading it."""
+        return os.path.exists(os.path.join(self._entry_dir(stage, key), 'meta.json'))
+
+    def load(self, stage, key):
+        """Returns the stored dict for (stage, key), or None on a miss."""
+        entry = self._entry_dir(stage, key)
+        meta_path = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            values = {}
+            for name, spec in meta['values'].items():
+                if spec is None:
+                    values[name] = None
+                elif spec['type'] == 'image':
+                    values[name] = ants.image_read(os.path.join(entry, spec['file']))
+                elif spec['type'] == 'json':
+                    values[name] = spec['value']
+                else:
+                    values[name] = [os.path.join(entry, p) for p in spec['files']]
+                    if not all(os.path.exists(p) for p in values[name]):
+                        return None
+            # Directory mtime records the last access for LRU eviction
+            os.utime(entry, None)
+        except Exception as e:
+            # e.g. evicted by another worker while being read
+            logger.warning("Unreadable stage cache entry %s/%s: %s", stage, key, e)
+            return None
+        return values
+
+    def save(self, stage, key, values, writer=None):
+        """
+        Stores a dict of stage outputs under (stage, key).
+
+        Args:
+            writer (AsyncImageWriter, optional): Writes the entry in the background
+                instead of on the caller's thread. Files listed in `values` must
+                exist by the time the job runs (writes queued earlier on the same
+                writer have finished by then).
+        """
+        if writer is not None:
+            writer.submit(self._save, stage, key, values)
+        else:
+            self._save(stage, key, values)
+
+    def _save(self, stage, key, values):
+        entry = self._entry_dir(stage, key)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix=f'.{key}-', dir=os.path.dirname(entry))
+        except OSError as e:
+            logger.warning("Could not cache %s/%s: %s", stage, key, e)
+            return
+        meta = {'stage': stage, 'key': key, 'values': {}}
+        try:
+            for name, value in values.items():
+                if value is None:
+                    meta['values'][name] = None
+                elif isinstance(value, ants.core.ants_image.ANTsImage):
+                    path = write_image(value, codec_path(os.path.join(tmp_dir, f'{name}.nii.gz'), self.codec),
+                                       codec=self.codec)
+                    meta['values'][name] = {'type': 'image', 'file': os.path.basename(path)}
+                elif isinstance(value, dict):
+                    meta['values'][name] = {'type': 'json', 'value': value}
+                else:
+                    files = []
+                    for i, src in enumerate(value):
+                        fname = f'{name}_{i}_{os.path.basename(src)}'
+                        shutil.copyfile(src, os.path.join(tmp_dir, fname))
+                        files.append(fname)
+                    meta['values'][name] = {'type': 'files', 'files': files}
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp_dir, entry)
+        except Exception as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.warning("Could not cache %s/%s: %s", stage, key, e)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size_gb."""
+        entries = []
+        total = 0
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for name in os.listdir(stage_dir):
+                entry = os.path.join(stage_dir, name)
+                if name.startswith('.') or not os.path.isdir(entry):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue  # Removed concurrently by another worker
+                total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logger.info("Evicted stage cache entry %s", os.path.relpath(entry, self.cache_dir))
+
+
+class SubjectStages:
+    """
+    Pull-based evaluation of one subject's stage graph.
+
+    `run(stage, compute)` returns the stage outputs from the in-memory memo,
+    then from the StageCache, and only calls `compute()` when both miss.
+    Upstream stages are pulled from inside `compute`, so a fully cached
+    downstream stage never loads or recomputes what it depends on.
+    """
+
+    def __init__(self, cache, keys, log=None, writer=None):
+        self.cache = cache
+        self.keys = keys
+        self.log = log or logger
+        # Background writer for cache saves (see StageCache.save)
+        self.writer = writer
+        self._memo = {}
+
+    def run(self, stage, compute, key=None):
+        key = key or self.keys.get(stage)
+        memo_key = (stage, key)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+        values = None
+        if self.cache is not None and key is not None:
+            values = self.cache.load(stage, key)
+            if values is not None:
+                self.log.info(f"Stage cache hit: {stage} ({key})")
+        if values is None:
+            values = compute()
+            if self.cache is not None and key is not None:
+                self.cache.save(stage, key, values, writer=self.writer)
+        self._memo[memo_key] = values
+        return values
@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import ants
+
+
+def _transform_ext(path):
+    """Extension of an ANTs transform file ('.mat' affine, '.nii.gz' warp field)."""
+    if path.endswith('.nii.gz'):
+        return '.nii.gz'
+    return os.path.splitext(path)[1]
+
+
+class TransformStore:
+    """
+    Registration transforms kept next to the pipeline outputs.
+
+    Layout: <root>/<subject>/ holds the copied transform files, the moving
+    images they apply to (unless an intermediate already holds them) and
+    manifest.json:
+
+        {"subject": "sub-01.nii.gz",
+         "hr": {"moving": ..., "transforms": [...], "output": ...},
+         "lr": {"thick_3mm": {"moving": ..., "transforms": [...], "output": ...}}}
+
+    Transform lists are in ants.apply_transforms order. Paths are absolute.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _subject_path(self, filename):
+        base_name = filename.replace('.nii.gz', '').replace('.nii', '')
+        return os.path.join(self.root, base_name)
+
+    def subject_dir(self, filename):
+        """Subject directory, created on first use."""
+        path = self._subject_path(filename)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def save_transforms(self, filename, name, transforms):
+        """Copies `transforms` (e.g. `fwdtransforms`) into the subject directory."""
+        subject_dir = self.subject_dir(filename)
+        saved = []
+        for i, src in enumerate(transforms):
+            dst = os.path.join(subject_dir, f"{name}_{i}{_transform_ext(src)}")
+            if os.path.abspath(src) != os.path.abspath(dst):
+                shutil.copyfile(src, dst)
+            saved.append(os.path.abspath(dst))
+        return saved
+
+    def save_moving(self, filename, name, image):
+        """Writes the moving image of a transform and returns its path."""
+        path = os.path.join(self.subject_dir(filename), f"{name}_moving.nii.gz")
+        ants.image_write(image, path)
+        return os.path.abspath(path)
+
+    def copy_moving(self, filename, name, src):
+        """Copies an existing moving image file (e.g. from the stage cache) and returns its path."""
+        path = os.path.join(self.subject_dir(filename), f"{name}_moving{_transform_ext(src)}")
+        shutil.copyfile(src, path)
+        return os.path.abspath(path)
+
+    def _manifest_path(self, filename):
+        return os.path.join(self._subject_path(filename), 'manifest.json')
+
+    def load_manifest(self, filename):
+        path = self._manifest_path(filename)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def write_manifest(self, filename, manifest):
+        path = os.path.join(self.subject_dir(filename), 'manifest.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def manifests(self):
+        """Yields every stored manifest, sorted by subject directory."""
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name, 'manifest.json')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    yield json.load(f)
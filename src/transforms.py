@@ -0,0 +1,125 @@
+import numpy as np
+import ants
+from monai.transforms import MapTransform, RandomizableTransform
+from monai.utils.type_conversion import convert_to_dst_type
+from .degradation import DegradationSimulator
+
+
+def _resample_axis(data, axis, positions):
+    """Linear interpolation of `data` along `axis` at fractional indices (clamped to the edges)."""
+    n = data.shape[axis]
+    positions = np.clip(positions, 0, n - 1)
+    lo = np.floor(positions).astype(int)
+    hi = np.minimum(lo + 1, n - 1)
+    shape = [1] * data.ndim
+    shape[axis] = positions.size
+    frac = (positions - lo).reshape(shape)
+    return np.take(data, lo, axis=axis) * (1.0 - frac) + np.take(data, hi, axis=axis) * frac
+
+
+def resample_to_grid(lr_image, hr_shape, hr_spacing):
+    """
+    Resamples an LR ANTsImage produced by DegradationSimulator from an
+    axis-aligned HR grid (origin 0, identity direction) back onto that grid,
+    like the LR -> HR resampling of the preprocessing pipeline. Edge slices
+    beyond the last LR sample are clamped rather than zero-filled.
+    """
+    data = lr_image.numpy().astype(np.float32, copy=False)
+    for axis, n_hr in enumerate(hr_shape):
+        hr_coords = np.arange(n_hr) * hr_spacing[axis]
+        positions = (hr_coords - lr_image.origin[axis]) / lr_image.spacing[axis]
+        data = _resample_axis(data, axis, positions)
+    return data.astype(np.float32, copy=False)
+
+
+class RandSliceDegradationd(RandomizableTransform, MapTransform):
+    """
+    Synthesizes a low-resolution partner for an HR patch at training time.
+
+    Thickness, gap and in-plane factor are drawn per call from the given
+    distributions and applied with the same DegradationSimulator physics the
+    preprocessing pipeline uses (slab integration with the configured slice
+    profile, in-plane k-space truncation). The LR result is resampled back
+    onto the HR patch grid, matching the paired LR files the pipeline writes,
+    and stored under `lr_key`. This replaces pre-materialized LR variants with
+    a sampling distribution and removes their storage cost.
+    """
+
+    def __init__(
+        self,
+        keys,
+        lr_key='lr',
+        thickness_mm=(2.0, 5.0),
+        gap_mm=(0.0, 1.0),
+        in_plane_factors=(1, 2),
+        slice_profile='boxcar',
+        slice_axis=2,
+        spacing=None,
+        prob=1.0,
+        allow_missing_keys=False,
+    ):
+        """
+        Args:
+            keys: Key of the HR image (one key).
+            lr_key (str): Key the synthesized LR image is written to.
+            thickness_mm (tuple): (min, max) slice thickness, sampled uniformly.
+            gap_mm (tuple): (min, max) inter-slice gap, sampled uniformly.
+            in_plane_factors (sequence): In-plane downsample factors, sampled uniformly (1 = none).
+            slice_profile (str): Slice profile passed to DegradationSimulator.
+            slice_axis (int): Spatial axis of slice acquisition (0-2).
+            spacing (tuple, optional): HR voxel spacing in mm. Read from the
+                image's `pixdim` (MetaTensor) when not given.
+            prob (float): Probability of degrading; otherwise LR is a copy of HR.
+        """
+        MapTransform.__init__(self, keys, allow_missing_keys)
+        RandomizableTransform.__init__(self, prob)
+        if len(self.keys) != 1:
+            raise ValueError("RandSliceDegradationd expects exactly one HR key.")
+        self.lr_key = lr_key
+        self.thickness_mm = tuple(float(v) for v in thickness_mm)
+        self.gap_mm = tuple(float(v) for v in gap_mm)
+        self.in_plane_factors = tuple(int(f) for f in in_plane_factors)
+        self.slice_profile = slice_profile
+        self.slice_axis = slice_axis
+        self.spacing = spacing
+        self._thickness = self._gap = None
+        self._factor = 1
+
+    def randomize(self, data=None):
+        super().randomize(None)
+        if not self._do_transform:
+            return
+        self._thickness = self.R.uniform(*self.thickness_mm)
+        self._gap = self.R.uniform(*self.gap_mm)
+        self._factor = int(self.R.choice(self.in_plane_factors))
+
+    def _degrade(self, volume, spacing):
+        hr = ants.from_numpy(volume.astype(np.float32), origin=(0.0,) * volume.ndim, spacing=tuple(spacing))
+        # Thickness below the HR spacing cannot be simulated; clamp to one voxel
+        thickness = max(self._thickness, spacing[self.slice_axis])
+        lr = DegradationSimulator(hr).simulate_inter_slice_gap(
+            thickness_mm=thickness, gap_mm=self._gap,
+            slice_axis=self.slice_axis, profile=self.slice_profile
+        )
+        if self._factor > 1:
+            lr = DegradationSimulator(lr).simulate_in_plane_resolution(
+                self._factor, slice_axis=self.slice_axis
+            )
+        return resample_to_grid(lr, volume.shape, spacing)
+
+    def __call__(self, data):
+        d = dict(data)
+        self.randomize()
+        for key in self.key_iterator(d):
+            img = d[key]
+            if not self._do_transform:
+                d[self.lr_key] = img.clone() if hasattr(img, 'clone') else np.copy(img)
+                continue
+            spacing = self.spacing
+            if spacing is None:
+                spacing = tuple(float(s) for s in np.asarray(getattr(img, 'pixdim', (1.0, 1.0, 1.0)))[:3])
+            arr = np.asarray(img.detach().cpu().numpy() if hasattr(img, 'detach') else img)
+            # (C, X, Y, Z): degrade each channel independently
+            lr = np.stack([self._degrade(channel, spacing) for channel in arr])
+            d[self.lr_key] = convert_to_dst_type(lr, dst=img)[0]
+        return d
@@ -1,10 +1,15 @@
+import os
+import json
+import hashlib
 import logging
 import ants
 import numpy as np
 
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
 def setup_logger(name, log_file, level=logging.INFO):
     """Configures a robust logger for tracking pipeline progress."""
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter(LOG_FORMAT)
     handler = logging.FileHandler(log_file)
     handler.setFormatter(formatter)
     console = logging.StreamHandler()
@@ -15,6 +20,24 @@ def setup_logger(name, log_file, level=logging.INFO):
     logger.addHandler(console)
     return logger
 
+def set_log_file(logger, log_file):
+    """
+    Points the logger's file output at `log_file`, replacing (and closing) its
+    current file handler. A no-op if it already writes there; None only
+    removes the file handler.
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.FileHandler):
+            if log_file is not None and handler.baseFilename == os.path.abspath(log_file):
+                return logger
+            logger.removeHandler(handler)
+            handler.close()
+    if log_file is not None:
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.addHandler(handler)
+    return logger
+
 def ants_to_numpy(ants_image):
     """Safely convert ANTsImage to Numpy array."""
     return ants_image.numpy()
@@ -34,4 +57,109 @@ def numpy_to_ants(numpy_array, reference_image):
         spacing=reference_image.spacing,
         direction=reference_image.direction,
         has_components=reference_image.has_components
-    )
\ No newline at end of file
+    )
+
+def mask_bounding_box(mask_array, margin_vox=0):
+    """
+    Index bounding box of the non-zero voxels of a mask, grown by a margin.
+
+    Args:
+        mask_array (np.ndarray): Mask volume.
+        margin_vox (int or sequence): Margin in voxels (scalar or per axis).
+
+    Returns:
+        tuple: (lower, upper) index lists (upper exclusive), or None if the mask is empty.
+    """
+    mask_array = np.asarray(mask_array) > 0
+    if not mask_array.any():
+        return None
+    margins = np.broadcast_to(margin_vox, (mask_array.ndim,))
+    lower, upper = [], []
+    for axis in range(mask_array.ndim):
+        # Project onto one axis instead of materializing all non-zero coordinates
+        other_axes = tuple(a for a in range(mask_array.ndim) if a != axis)
+        hits = np.flatnonzero(mask_array.any(axis=other_axes))
+        lower.append(max(0, int(hits[0]) - int(margins[axis])))
+        upper.append(min(mask_array.shape[axis], int(hits[-1]) + 1 + int(margins[axis])))
+    return lower, upper
+
+def crop_to_box(image, lower, upper):
+    """
+    Crops an ANTsImage to the index box [lower, upper), shifting the origin so
+    every remaining voxel keeps its physical position.
+    """
+    sl = tuple(slice(lo, hi) for lo, hi in zip(lower, upper))
+    data = np.ascontiguousarray(image.numpy()[sl])
+
+    # Offset of the first kept voxel, rotated into physical space
+    dim = image.dimension
+    direction_mat = np.array(image.direction).reshape(dim, dim)
+    offset = np.array(lower, dtype=float) * np.array(image.spacing)
+    new_origin = np.array(image.origin) + direction_mat @ offset
+
+    return ants.from_numpy(
+        data,
+        origin=tuple(new_origin),
+        spacing=image.spacing,
+        direction=image.direction
+    )
+
+def crop_to_mask(image, mask, margin_mm=0.0):
+    """
+    Crops `image` to the bounding box of `mask` (same grid) plus a margin in mm.
+
+    Returns:
+        ants.ANTsImage: The cropped image, or `image` unchanged if the mask is empty.
+    """
+    margin_vox = [int(np.ceil(float(margin_mm) / s)) for s in image.spacing]
+    box = mask_bounding_box(mask.numpy(), margin_vox)
+    if box is None:
+        return image
+    return crop_to_box(image, *box)
+
+def file_fingerprint(path, block_bytes=1 << 22):
+    """
+    Content fingerprint of a file: a hash of its size and full contents.
+
+    Stable across copies/moves, and changes on any edit (including in-place
+    edits to the middle of an uncompressed .nii).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(os.path.getsize(path)).encode())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_bytes), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def get_config_value(cfg, dotted_key, default=None):
+    """Looks up 'a.b.c' in a nested config dict."""
+    node = cfg
+    for part in dotted_key.split('.'):
+        if not isinstance(node, dict) or part not in node:
+            return default
+        node = node[part]
+    return node
+
+def select_file_digests(file_digests, keys):
+    """Entries of `file_digests` whose dotted key lies under one of `keys`."""
+    return {
+        k: v for k, v in (file_digests or {}).items()
+        if any(k == key or k.startswith(key + '.') for key in keys)
+    }
+
+def hash_config(cfg, keys, file_digests=None):
+    """
+    Stable hash of the config sections that affect pipeline outputs.
+
+    Args:
+        cfg (dict): Parsed YAML config.
+        keys (iterable): Dotted keys to include (e.g. 'preprocessing.normalization').
+        file_digests (dict, optional): Dotted key of a path-valued setting -> content
+            digest of that file, so rewriting the file in place changes the hash.
+    """
+    subset = {k: get_config_value(cfg, k) for k in keys}
+    files = select_file_digests(file_digests, keys)
+    if files:
+        subset['files'] = files
+    payload = json.dumps(subset, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
@@ -132,7 +132,8 @@ def compare_mri_histograms(file_list, labels=None, bins=100, title="MRI Comparis
     Compare intensity distributions of multiple MRI scans in a single plot.
     
     Args:
-        file_list (list): List of paths to .nii.gz MRI files
+        file_list (list): List of paths to .nii.gz MRI files (or numpy arrays,
+            e.g. read from a ZarrIntermediateStore)
         labels (list, optional): Labels for each file. If None, uses filenames
         bins (int): Number of bins for the histogram (default: 100)
         title (str): Title for the comparison plot
@@ -146,7 +147,7 @@ def compare_mri_histograms(file_list, labels=None, bins=100, title="MRI Comparis
         >>> stats = compare_mri_histograms(files, labels=['Before', 'After'])
     """
     if labels is None:
-        labels = [Path(f).name for f in file_list]
+        labels = [Path(f).name if not isinstance(f, np.ndarray) else f"array {i}" for i, f in enumerate(file_list)]
     
     fig, ax = plt.subplots(figsize=(14, 8))
     all_stats = {}
@@ -154,8 +155,11 @@ def compare_mri_histograms(file_list, labels=None, bins=100, title="MRI Comparis
     
     for idx, (file_path, label) in enumerate(zip(file_list, labels)):
         # Load the MRI scan
-        nii_img = nib.load(str(file_path))
-        data = nii_img.get_fdata()
+        if isinstance(file_path, np.ndarray):
+            data = file_path
+        else:
+            nii_img = nib.load(str(file_path))
+            data = nii_img.get_fdata()
         data_flat = data.flatten()
         non_zero_data = data_flat[data_flat > 0]
         
@@ -0,0 +1,159 @@
+import os
+import gzip
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+import ants
+
+logger = logging.getLogger(__name__)
+
+# NIfTI codecs for pipeline outputs:
+#   gzip  - ants.image_write default (.nii.gz, zlib level 6, single thread)
+#   gzip1 - .nii.gz at zlib level 1 (much faster, slightly larger files)
+#   pigz  - .nii.gz compressed by the multi-threaded `pigz` binary
+#   nii   - uncompressed .nii
+CODECS = ('gzip', 'gzip1', 'pigz', 'nii')
+
+
+def codec_path(path, codec):
+    """Output path for `codec`: 'nii' drops the .gz suffix, other codecs keep `path`."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown output codec: {codec}")
+    if codec == 'nii' and path.endswith('.nii.gz'):
+        return path[:-len('.gz')]
+    return path
+
+
+def write_image(image, path, codec='gzip', threads=None):
+    """
+    Writes an ANTsImage with the given codec. Compressed files are written
+    to a temporary name first, so readers never see a partial .nii.gz.
+
+    Args:
+        image (ants.ANTsImage): Image to write.
+        path (str): Destination (see codec_path).
+        codec (str): One of CODECS.
+        threads (int, optional): pigz threads (default: all cores).
+    """
+    path = codec_path(path, codec)
+    if codec == 'gzip' or not path.endswith('.nii.gz'):
+        # ITK picks the format (and compression) from the extension
+        ants.image_write(image, path)
+        return path
+
+    raw_path = path[:-len('.nii.gz')] + f'.{os.getpid()}.{threading.get_ident()}.tmp.nii'
+    gz_path = raw_path + '.gz'
+    try:
+        ants.image_write(image, raw_path)
+        if codec == 'pigz' and shutil.which('pigz'):
+            with open(gz_path, 'wb') as dst:
+                subprocess.run(
+                    ['pigz', '-c', '-p', str(threads or os.cpu_count() or 1), raw_path],
+                    stdout=dst, check=True
+                )
+        else:
+            if codec == 'pigz':
+                logger.warning("pigz not found on PATH; using gzip level 1")
+            with open(raw_path, 'rb') as src, gzip.open(gz_path, 'wb', compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst, 1 << 22)
+        os.replace(gz_path, path)
+    finally:
+        for tmp in (raw_path, gz_path):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return path
+
+
+class WriteError(RuntimeError):
+    """
+    One or more background writes failed. `failures` maps the path of each
+    failed write (None for jobs submitted without one) to its error message.
+    """
+
+    def __init__(self, message, failures=None):
+        super().__init__(message)
+        self.failures = failures or {}
+
+
+class AsyncImageWriter:
+    """
+    Background thread that performs file writes off the compute path.
+
+    Jobs are queued in a bounded queue (submit blocks when it is full, which
+    caps the memory held by pending images). flush() waits for every queued
+    job and raises WriteError if any of them failed since the last flush.
+    Queued images must not be modified by the caller afterwards.
+    """
+
+    def __init__(self, max_pending=8):
+        self._queue = queue.Queue(maxsize=max(1, int(max_pending)))
+        self._lock = threading.Lock()
+        self._errors = []
+        self._pending_paths = {}
+        self._thread = threading.Thread(target=self._run, name='image-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs, path = job
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e:
+                    with self._lock:
+                        self._errors.append((path, f"{path or fn.__name__}: {e}"))
+                finally:
+                    if path is not None:
+                        with self._lock:
+                            self._pending_paths[path] -= 1
+                            if not self._pending_paths[path]:
+                                del self._pending_paths[path]
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args, path=None, **kwargs):
+        """Queues fn(*args, **kwargs). `path` names the file it writes (for is_pending/errors)."""
+        if path is not None:
+            with self._lock:
+                self._pending_paths[path] = self._pending_paths.get(path, 0) + 1
+        self._queue.put((fn, args, kwargs, path))
+
+    def write(self, image, path, codec='gzip', threads=None):
+        """Queues write_image(); returns the final path for `codec`."""
+        path = codec_path(path, codec)
+        self.submit(write_image, image, path, codec=codec, threads=threads, path=path)
+        return path
+
+    def is_pending(self, path):
+        """True while a write to `path` is queued or in progress."""
+        with self._lock:
+            return path in self._pending_paths
+
+    def has_failed(self, path):
+        """True if a write to `path` failed since the last flush (usable from queued jobs)."""
+        with self._lock:
+            return any(failed == path for failed, _ in self._errors)
+
+    def flush(self):
+        """Blocks until all queued writes are done; raises WriteError on failures."""
+        self._queue.join()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise WriteError(
+                f"{len(errors)} write(s) failed: " + "; ".join(message for _, message in errors),
+                failures={path: message for path, message in errors},
+            )
+
+    def close(self):
+        """Flushes and stops the writer thread."""
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
@@ -10,66 +10,93 @@ from monai.transforms import (
     RandFlipd,
     RandRotate90d,
     EnsureTyped,
-    NormalizeIntensityd 
+    NormalizeIntensityd
 )
+from src.transforms import RandSliceDegradationd
 
-def get_dataloader(data_dir, batch_size=4, patch_size=(96, 96, 96), num_workers=4):
+def get_dataloader(data_dir, batch_size=4, patch_size=(96, 96, 96), num_workers=4, degradation=None):
     """
     Constructs a high-performance MONAI DataLoader for WGAN training.
+
+    Args:
+        degradation (dict, optional): If given, LR patches are synthesized on the fly
+            from the HR volumes with RandSliceDegradationd (keyword arguments such as
+            thickness_mm, gap_mm, in_plane_factors, slice_profile) instead of
+            reading pre-materialized variants from data_dir/LR.
     """
+    keys = ["hr", "lr"]
+
     # 1. Gather file paths
-    # We assume filenames match exactly between HR and LR folders
-    hr_images = sorted(glob.glob(os.path.join(data_dir, "HR", "*.nii.gz")))
-    lr_images = sorted(glob.glob(os.path.join(data_dir, "LR", "*.nii.gz")))
-    
-    data_dicts =
-    
+    # Outputs are .nii.gz, or .nii with the pipeline's uncompressed 'nii' codec
+    hr_images = sorted(glob.glob(os.path.join(data_dir, "HR", "*.nii.gz")) + glob.glob(os.path.join(data_dir, "HR", "*.nii")))
+    if degradation is not None:
+        data_dicts = [{"hr": hr} for hr in hr_images]
+    else:
+        # Pair every LR variant (<subject>_<suffix>.nii.gz) with its HR scan (<subject>.nii.gz)
+        data_dicts = []
+        for hr in hr_images:
+            base_name = os.path.basename(hr).replace('.nii.gz', '').replace('.nii', '')
+            for lr in sorted(glob.glob(os.path.join(data_dir, "LR", f"{base_name}_*.nii*"))):
+                data_dicts.append({"hr": hr, "lr": lr})
+
     # 2. Define Transforms Pipeline
-    train_transforms = Compose(),
-        
-        # Add channel dimension: (D, H, W) -> (C, D, H, W). C=1 for T1w.
-        EnsureChannelFirstd(keys=), 
-        
-        # Patch Extraction
-        # Extract 96^3 patches. If image is smaller, it pads automatically (if config allowed)
-        # random_size=False ensures fixed patch size.
-        RandSpatialCropd(
-            keys=,
-            roi_size=patch_size,
-            random_size=False
-        ),
-        
+    if degradation is not None:
+        load_transforms = [
+            LoadImaged(keys=["hr"]),
+            EnsureChannelFirstd(keys=["hr"]),
+            RandSpatialCropd(keys=["hr"], roi_size=patch_size, random_size=False),
+            # Synthesize the LR partner of each patch (thickness/gap/in-plane sampled per patch)
+            RandSliceDegradationd(keys="hr", lr_key="lr", **degradation),
+        ]
+    else:
+        load_transforms = [
+            LoadImaged(keys=keys),
+
+            # Add channel dimension: (D, H, W) -> (C, D, H, W). C=1 for T1w.
+            EnsureChannelFirstd(keys=keys),
+
+            # Patch Extraction
+            # Extract 96^3 patches. If image is smaller, it pads automatically (if config allowed)
+            # random_size=False ensures fixed patch size.
+            RandSpatialCropd(
+                keys=keys,
+                roi_size=patch_size,
+                random_size=False
+            ),
+        ]
+
+    train_transforms = Compose(load_transforms + [
         # Data Augmentation
         # Crucial for GANs to prevent overfitting.
         # We perform rigid augmentations (Flip/Rotate) to preserve anatomy.
-        # Note: We do NOT use elastic deformations here as they might introduce 
+        # Note: We do NOT use elastic deformations here as they might introduce
         # non-physical distortions that confuse the Super-Resolution task.
-        RandFlipd(keys=, prob=0.5, spatial_axis=0),
-        RandFlipd(keys=, prob=0.5, spatial_axis=1),
-        RandFlipd(keys=, prob=0.5, spatial_axis=2),
-        RandRotate90d(keys=, prob=0.25, spatial_axes=(0, 1)),
-        
+        RandFlipd(keys=keys, prob=0.5, spatial_axis=0),
+        RandFlipd(keys=keys, prob=0.5, spatial_axis=1),
+        RandFlipd(keys=keys, prob=0.5, spatial_axis=2),
+        RandRotate90d(keys=keys, prob=0.25, spatial_axes=(0, 1)),
+
         # Final Tensor Conversion
-        EnsureTyped(keys=, dtype="float32")
+        EnsureTyped(keys=keys, dtype="float32")
     ])
-    
+
     # 3. CacheDataset
     # This loads all NIfTI files into RAM (if cache_rate=1.0).
     # This removes disk I/O bottlenecks during training.
     # For massive datasets (HCP), adjust cache_rate or use PersistentDataset (disk cache).
     ds = CacheDataset(
-        data=data_dicts, 
-        transform=train_transforms, 
-        cache_rate=1.0, 
+        data=data_dicts,
+        transform=train_transforms,
+        cache_rate=1.0,
         num_workers=num_workers
     )
-    
+
     loader = DataLoader(
-        ds, 
-        batch_size=batch_size, 
-        shuffle=True, 
+        ds,
+        batch_size=batch_size,
+        shuffle=True,
         num_workers=num_workers,
         pin_memory=True # Faster transfer to GPU
     )
-    
-    return loader
\ No newline at end of file
+
+    return loader
@@ -0,0 +1,79 @@
+import os
+import sys
+import glob
+import argparse
+import ants
+import numpy as np
+import yaml
+
+from src.brain_extraction import BrainExtractor
+
+
+def dice(mask_a, mask_b):
+    """Dice overlap of two binary masks on the same grid."""
+    a = mask_a.numpy() > 0
+    b = mask_b.numpy() > 0
+    total = int(a.sum()) + int(b.sum())
+    if total == 0:
+        return 1.0
+    return 2.0 * int(np.logical_and(a, b).sum()) / total
+
+
+def verify(config_path, images, min_dice):
+    with open(config_path, 'r') as f:
+        be_cfg = yaml.safe_load(f)['preprocessing']['brain_extraction']
+    # No cache: both paths must run inference
+    extractor = BrainExtractor(
+        device=be_cfg['device'],
+        disable_tta=be_cfg['disable_tta'],
+        keep_mask=False,
+        in_memory=False,
+    )
+    if not extractor._in_memory_supported():
+        print("FAILED: the HD-BET model does not read images with SimpleITK; in_memory is not supported.")
+        sys.exit(1)
+
+    print(f"{'image':<40} {'dice':>8} {'mismatch':>10} {'file voxels':>12} {'memory voxels':>14}")
+    failed = []
+    for path in images:
+        image = ants.image_read(path)
+        _, file_mask = extractor.extract_brain(image, return_mask=True)
+        _, memory_mask = extractor.extract_brain_in_memory(image)
+        if file_mask.shape != memory_mask.shape:
+            print(f"{os.path.basename(path):<40} shape mismatch: {file_mask.shape} vs {memory_mask.shape}")
+            failed.append(path)
+            continue
+        score = dice(file_mask, memory_mask)
+        file_np = file_mask.numpy() > 0
+        memory_np = memory_mask.numpy() > 0
+        mismatch = int(np.count_nonzero(file_np != memory_np))
+        print(f"{os.path.basename(path):<40} {score:>8.5f} {mismatch:>10} "
+              f"{int(file_np.sum()):>12} {int(memory_np.sum()):>14}")
+        if score < min_dice:
+            failed.append(path)
+
+    if failed:
+        print(f"FAILED: {len(failed)} of {len(images)} masks differ from the file-based path (dice < {min_dice}).")
+        sys.exit(1)
+    print(f"SUCCESS: in-memory masks match the file-based path on {len(images)} image(s).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare HD-BET masks of the in-memory path against the file-based hdbet_predict path"
+    )
+    parser.add_argument("--config", type=str, default="./configs/config.yaml", help="Path to config")
+    parser.add_argument("images", nargs="*", help="Sample NIfTI images (default: first --n files of input_dir)")
+    parser.add_argument("--n", type=int, default=1, help="Number of input_dir images when none are given")
+    parser.add_argument("--min-dice", type=float, default=0.999, help="Minimum Dice overlap per image")
+    args = parser.parse_args()
+
+    images = args.images
+    if not images:
+        with open(args.config, 'r') as f:
+            input_dir = yaml.safe_load(f)['paths']['input_dir']
+        images = sorted(glob.glob(os.path.join(input_dir, "*.nii*")))[:args.n]
+    if not images:
+        print("No images to compare.")
+        sys.exit(1)
+    verify(args.config, images, args.min_dice)